@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+import os
+import time
+import wave
+import threading
+import subprocess
+# The mixer (and numpy, seconds to import on a Pi Zero) is imported on
+# first use, so daemons can start connecting before paying for it
+
+# Format everything is converted to, and the output stream runs at
+ENGINE_RATE = 44100
+ENGINE_CHANNELS = 2
+ENGINE_WIDTH = 2  # bytes per sample, the mixer works in 16 bit
+# Frames written to the sink at a time (~23ms at 44.1kHz)
+BLOCK_FRAMES = 1024
+APLAY = "/usr/bin/aplay"
+# ALSA buffer for the persistent aplay stream, in microseconds
+APLAY_BUFFER_TIME = 50000
+
+
+class Sound():
+
+    def __init__(self, name, pcm, rate, channels, width):
+        # Decoded, ready to play PCM
+        self.name = name
+        self.pcm = pcm
+        self.rate = rate
+        self.channels = channels
+        self.width = width
+        # Float samples for the mixer, converted once on first play
+        self.samples = None
+
+    def mix_samples(self):
+        """ Samples as a float array ready for mixing """
+        if self.samples is None:
+            import mixer
+            self.samples = mixer.to_float(self.pcm, self.channels)
+        return self.samples
+
+    def frame_size(self):
+        return self.channels * self.width
+
+    def frames(self):
+        return len(self.pcm) // self.frame_size()
+
+    def duration(self):
+        return float(self.frames()) / self.rate
+
+
+def load_wav(filename, rate=ENGINE_RATE, channels=ENGINE_CHANNELS, width=ENGINE_WIDTH):
+    """ Decode a WAV file into memory, converted to the engine format """
+    f = wave.open(filename, "rb")
+    try:
+        src_channels = f.getnchannels()
+        src_width = f.getsampwidth()
+        src_rate = f.getframerate()
+        pcm = f.readframes(f.getnframes())
+    finally:
+        f.close()
+
+    if (src_width, src_channels, src_rate) != (width, channels, rate):
+        import mixer
+        pcm = mixer.convert(pcm, src_width, src_channels, src_rate, width, channels, rate)
+    return Sound(os.path.basename(filename), pcm, rate, channels, width)
+
+
+def pcm_format(width):
+    """ aplay sample format name for a sample width """
+    if width == 1:
+        return "U8"
+    if width == 4:
+        return "S32_LE"
+    return "S16_LE"
+
+
+class NullSink():
+
+    def __init__(self, realtime=False):
+        # Discards audio, handy for headless testing.
+        # With realtime set, writes take as long as the audio would
+        # to play, like a real device.
+        self.realtime = realtime
+        self.bytes_per_second = 0
+        self.bytes_written = 0
+        self.blocks_written = 0
+
+    def open(self, rate, channels, width):
+        self.bytes_per_second = rate * channels * width
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        self.blocks_written += 1
+        if self.realtime and self.bytes_per_second > 0:
+            time.sleep(float(len(data)) / self.bytes_per_second)
+
+    def close(self):
+        return
+
+
+class FileSink():
+
+    def __init__(self, filename):
+        # Writes everything played to a WAV file
+        self.filename = filename
+        self.file = None
+
+    def open(self, rate, channels, width):
+        self.file = wave.open(self.filename, "wb")
+        self.file.setnchannels(channels)
+        self.file.setsampwidth(width)
+        self.file.setframerate(rate)
+
+    def write(self, data):
+        self.file.writeframes(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class PipeSink():
+
+    def __init__(self, command=APLAY, extra_args=None):
+        # Single long running aplay, fed raw PCM on stdin
+        self.command = command
+        # e.g. ["-D", "null"] to pick another device
+        self.extra_args = extra_args or []
+        self.process = None
+        self.args = None
+
+    def open(self, rate, channels, width):
+        self.args = [
+            self.command, "-q", "-t", "raw",
+            "-f", pcm_format(width),
+            "-c", str(channels),
+            "-r", str(rate),
+            "--buffer-time=" + str(APLAY_BUFFER_TIME)
+        ] + self.extra_args + ["-"]
+        self._start()
+
+    def _start(self):
+        self.process = subprocess.Popen(self.args, stdin=subprocess.PIPE)
+
+    def write(self, data):
+        if self.process is None or self.process.poll() is not None:
+            # Player went away, start another
+            self._start()
+        try:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            self.process = None
+
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+            self.process.wait()
+            self.process = None
+
+
+class AlsaSink():
+
+    def __init__(self, device="default"):
+        # Writes straight to ALSA using pyalsaaudio
+        import alsaaudio
+        self.alsaaudio = alsaaudio
+        self.device = device
+        self.pcm = None
+
+    def open(self, rate, channels, width):
+        formats = {
+            1: self.alsaaudio.PCM_FORMAT_U8,
+            2: self.alsaaudio.PCM_FORMAT_S16_LE,
+            4: self.alsaaudio.PCM_FORMAT_S32_LE
+        }
+        self.pcm = self.alsaaudio.PCM(
+            self.alsaaudio.PCM_PLAYBACK, self.alsaaudio.PCM_NORMAL,
+            device=self.device
+        )
+        self.pcm.setchannels(channels)
+        self.pcm.setrate(rate)
+        self.pcm.setformat(formats[width])
+        self.pcm.setperiodsize(BLOCK_FRAMES)
+
+    def write(self, data):
+        self.pcm.write(data)
+
+    def close(self):
+        if self.pcm is not None:
+            self.pcm.close()
+            self.pcm = None
+
+
+def make_sink(spec=""):
+    """ Build a sink from a short description.
+    "" picks ALSA if pyalsaaudio is installed, otherwise aplay.
+    Also "alsa", "aplay", "null" or "file:/path/to/out.wav" """
+    if spec == "null":
+        return NullSink()
+    if spec.startswith("file:"):
+        return FileSink(spec[len("file:"):])
+    if spec == "aplay":
+        return PipeSink()
+    if spec == "alsa":
+        return AlsaSink()
+    try:
+        return AlsaSink()
+    except ImportError:
+        return PipeSink()
+
+
+class AudioEngine():
+
+    def __init__(self, sink, rate=ENGINE_RATE, channels=ENGINE_CHANNELS,
+                 block_frames=BLOCK_FRAMES, limit_number=4):
+        # Constructor
+        self.sink = sink
+        self.rate = rate
+        self.channels = channels
+        self.width = ENGINE_WIDTH
+        self.block_frames = block_frames
+        # Max sounds playing at once
+        self.limit_number = limit_number
+        # Sums the playing sounds, one block at a time
+        import mixer
+        self.mixer = mixer.Mixer(rate, channels, block_frames, limit_number)
+        self.wake = threading.Event()
+        self.exit = False
+        self.sink.open(rate, channels, self.width)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def play(self, sound, on_start=None):
+        """ Start a decoded Sound playing. on_start(monotonic time)
+        is called once its first block is handed to the sink """
+        # Oldest sound is faded out if over the limit
+        self.mixer.add(sound.name, sound.mix_samples(), on_start=on_start)
+        self.wake.set()
+
+    def play_at(self, sound, when, on_start=None):
+        """ Start a sound at a time on the monotonic clock.
+        Sleeps until just before, then starts it part way into a
+        block so it plays at the right sample rather than the next
+        block boundary """
+        lead = float(self.block_frames) / self.rate
+        wait = when - time.monotonic() - lead
+        if wait > 0:
+            timer = threading.Timer(wait, self._start_at, args=(sound, when, on_start))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._start_at(sound, when, on_start)
+
+    def _start_at(self, sound, when, on_start=None):
+        delay = when - time.monotonic()
+        delay_frames = 0
+        if delay > 0:
+            delay_frames = int(delay * self.rate)
+        self.mixer.add(sound.name, sound.mix_samples(), delay_frames, on_start)
+        self.wake.set()
+
+    def playing(self):
+        """ Number of sounds currently playing """
+        return self.mixer.active()
+
+    def run(self):
+        """ Audio thread, feeds the sink while anything is playing """
+        while not self.exit:
+            block = self.mixer.next_block()
+            if block is None:
+                # Idle, nothing is written so the stream drains to silence
+                self.wake.wait()
+                self.wake.clear()
+                continue
+            self.sink.write(block)
+            for on_start in self.mixer.take_started():
+                on_start(time.monotonic())
+
+    def stop(self):
+        self.exit = True
+        self.wake.set()
+        self.thread.join()
+        self.sink.close()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# Ring to sound latency benchmark for DoorBell_Ringer.
+#
+# Drives the ringer with bursts of DING/DONG through an in-process
+# broker stand-in and, for each playback backend, reports
+#   dispatch     - publish until the ringer's message callback runs
+#   first sample - publish until the ring's first audio is handed over
+#   cpu          - process (and child process) CPU time per ring
+#
+# Backends
+#   spawn     - the original ringer, one aplay process per event.
+#               First sample is when Popen returns, a lower bound.
+#   pipe      - one pre-spawned aplay fed raw PCM on stdin
+#   inprocess - mixer writing to an in-process sink (null, paced
+#               like a real device, unless --sink is given)
+#
+# e.g. python3 benchmark_ringer.py --bursts 50 --device null
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import subprocess
+import audio
+import events
+import metrics
+import eventbus
+import ratelimit
+import doorbell_ringer
+
+BACKENDS = ["spawn", "pipe", "inprocess"]
+# Ringer flood limits during a run, far above any burst so every ring
+# is timed rather than suppressed
+BENCH_RING_LIMIT = 1000000
+
+
+class BrokerStandIn():
+
+    def __init__(self):
+        # Local broker, delivering on its own thread like paho's
+        # network thread does
+        self.bus = eventbus.EventBus(mirror=False)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def client(self, client_id):
+        return self.bus.local_client(client_id)
+
+    def publish(self, topic, payload):
+        self.queue.put(eventbus.Message(topic, payload, 1))
+
+    def run(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                return
+            self.bus.dispatch(message)
+
+    def stop(self):
+        self.queue.put(None)
+
+
+class SpawnPlayer():
+
+    def __init__(self, bench, command, folder):
+        # The original way of ringing, a player process per event
+        self.bench = bench
+        self.command = command
+        self.folder = folder
+        self.processes = []
+
+    def play(self, sound, on_start=None):
+        self.processes.append(subprocess.Popen(
+            self.command + [os.path.join(self.folder, sound.name)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        ))
+        # Nothing to observe inside aplay, count the spawn
+        self.bench.handed_over(self.bench.take_played())
+        if on_start is not None:
+            on_start(time.monotonic())
+        return True
+
+    def playing(self):
+        self.processes = [p for p in self.processes if p.poll() is None]
+        return len(self.processes)
+
+    def stop(self):
+        for process in self.processes:
+            process.wait()
+
+
+class Bench():
+
+    def __init__(self, backend, args):
+        # Constructor
+        self.backend = backend
+        self.args = args
+        self.dispatch = metrics.LatencyRecorder("dispatch", window=100000)
+        self.first_sample = metrics.LatencyRecorder("first_sample", window=100000)
+        # Publish time of the message being handled, and of rings
+        # between passing the flood limits and play()
+        self.current = None
+        self.dispatched = []
+        # Publish times of rings handed to the mixer, not yet written
+        self.played = []
+        # Publish times of rings in the block being mixed
+        self.in_block = []
+        self.lock = threading.Lock()
+
+        self.broker = BrokerStandIn()
+        sink = self.make_sink()
+        self.ringer = doorbell_ringer.DoorBell_Ringer(
+            client=self.broker.client(doorbell_ringer.MQTT_CLIENT_ID),
+            sink=sink
+        )
+        self.ringer.library.stop()
+        self.ringer.clock.stop()
+        self.ringer.limiter = ratelimit.RateLimiter(BENCH_RING_LIMIT, BENCH_RING_LIMIT)
+        self.hook_ringer()
+        if backend == "spawn":
+            self.ringer.audio.stop()
+            self.ringer.audio = SpawnPlayer(
+                self, self.player_command(), args.sounds
+            )
+        else:
+            self.hook_engine()
+
+    def player_command(self):
+        command = [self.args.aplay, "-q"]
+        if self.args.device:
+            command += ["-D", self.args.device]
+        return command
+
+    def make_sink(self):
+        if self.backend == "pipe":
+            extra = []
+            if self.args.device:
+                extra = ["-D", self.args.device]
+            return audio.PipeSink(self.args.aplay, extra)
+        if self.backend == "inprocess" and self.args.sink:
+            return audio.make_sink(self.args.sink)
+        return audio.NullSink(realtime=True)
+
+    def hook_ringer(self):
+        """ Time each message as it reaches the ringer. Only rings
+        that pass its flood limits are followed to the player """
+        client = self.ringer.transport.client
+        on_message = client.on_message
+        allow = self.ringer.limiter.allow
+
+        def timed_on_message(mqttc, obj, message):
+            time_now = time.perf_counter()
+            name, fields = events.decode(message.payload)
+            sent = events.field_float(fields, "bench")
+            self.current = None
+            if sent is not None:
+                self.current = (sent, time_now)
+            on_message(mqttc, obj, message)
+
+        def timed_allow(source=None):
+            allowed = allow(source)
+            if allowed and self.current is not None:
+                sent, time_received = self.current
+                self.dispatch.record(time_received - sent)
+                self.lock.acquire()
+                try:
+                    self.dispatched.append(sent)
+                finally:
+                    self.lock.release()
+            return allowed
+
+        client.on_message = timed_on_message
+        self.ringer.limiter.allow = timed_allow
+
+    def take_played(self):
+        """ Rings dispatched since the last call """
+        self.lock.acquire()
+        try:
+            taken = self.dispatched
+            self.dispatched = []
+        finally:
+            self.lock.release()
+        return taken
+
+    def handed_over(self, sent_times):
+        time_now = time.perf_counter()
+        for sent in sent_times:
+            self.first_sample.record(time_now - sent)
+
+    def hook_engine(self):
+        """ Follow rings through the mixer to the sink """
+        engine = self.ringer.audio
+        play = engine.play
+        next_block = engine.mixer.next_block
+        write = engine.sink.write
+
+        def timed_play(sound, on_start=None):
+            result = play(sound, on_start)
+            taken = self.take_played()
+            self.lock.acquire()
+            try:
+                self.played.extend(taken)
+            finally:
+                self.lock.release()
+            return result
+
+        def timed_next_block():
+            # Rings added before this block is mixed are in it
+            self.lock.acquire()
+            try:
+                self.in_block = self.played
+                self.played = []
+            finally:
+                self.lock.release()
+            return next_block()
+
+        def timed_write(data):
+            # Handed over as the write starts, a device write may
+            # block for as long as the block takes to play
+            self.handed_over(self.in_block)
+            self.in_block = []
+            write(data)
+
+        engine.play = timed_play
+        engine.mixer.next_block = timed_next_block
+        engine.sink.write = timed_write
+
+    def run(self):
+        """ Publish the bursts and wait for them to be played """
+        cpu_start = os.times()
+        rings = 0
+        for burst in range(self.args.bursts):
+            for n in range(self.args.burst_size):
+                for name in (events.EVENT_DING, events.EVENT_DONG):
+                    self.broker.publish(
+                        doorbell_ringer.MQTT_TOPIC[0][0],
+                        events.encode(name, bench=time.perf_counter())
+                    )
+                    rings += 1
+            time.sleep(self.args.gap)
+
+        # Wait for every ring to reach its player
+        deadline = time.monotonic() + self.args.timeout
+        while self.first_sample.count < rings and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # And for the audio to finish, so CPU covers the whole ring
+        while self.ringer.audio.playing() > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.ringer.audio.stop()
+        self.broker.stop()
+        cpu_end = os.times()
+        cpu = (
+            (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)
+            + (cpu_end.children_user - cpu_start.children_user)
+            + (cpu_end.children_system - cpu_start.children_system)
+        )
+        return rings, cpu
+
+
+def report(backend, rings, cpu, bench):
+    print("{}:".format(backend))
+    print("  " + bench.dispatch.format_summary())
+    print("  " + bench.first_sample.format_summary())
+    if bench.first_sample.count < rings:
+        print("  {} of {} rings never reached the player".format(
+            rings - bench.first_sample.count, rings))
+    suppressed = bench.ringer.limiter.suppressed.total
+    if suppressed > 0:
+        print("  {} rings suppressed by the flood limits".format(suppressed))
+    print("  cpu: {:.3f}ms per ring".format(cpu * 1000.0 / max(1, rings)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ring to sound latency benchmark")
+    parser.add_argument("--backends", default=",".join(BACKENDS),
+                        help="comma separated, from " + ", ".join(BACKENDS))
+    parser.add_argument("--bursts", type=int, default=20)
+    parser.add_argument("--burst-size", type=int, default=3,
+                        help="DING/DONG pairs per burst")
+    parser.add_argument("--gap", type=float, default=0.25,
+                        help="seconds between bursts")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--sounds", default=doorbell_ringer.SOUNDS_FOLDER)
+    parser.add_argument("--aplay", default=audio.APLAY)
+    parser.add_argument("--device", default="",
+                        help="ALSA device for aplay, e.g. null")
+    parser.add_argument("--sink", default="",
+                        help="sink for the inprocess backend, e.g. file:/tmp/out.wav")
+    args = parser.parse_args()
+
+    doorbell_ringer.SOUNDS_FOLDER = args.sounds
+    for backend in args.backends.split(","):
+        if backend not in BACKENDS:
+            print("Unknown backend: " + backend)
+            continue
+        # Keep the ringer's logging out of the results
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            bench = Bench(backend, args)
+            rings, cpu = bench.run()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        report(backend, rings, cpu, bench)
+
+
+if __name__ == "__main__":
+    main()
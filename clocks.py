@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+import time
+import threading
+
+# Monotonic reading of a virtual clock when it is created
+VIRTUAL_MONOTONIC_START = 1000.0
+
+
+# The real clocks. Daemons take a clock so tests and simulations can
+# hand them a virtual one instead.
+class SystemClock():
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def localtime(self, seconds=None):
+        if seconds is None:
+            seconds = time.time()
+        return time.localtime(seconds)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+SYSTEM_CLOCK = SystemClock()
+
+
+# Clock running a fixed number of times faster than real time, e.g.
+# speed=60 plays an hour of animation in a minute. Can also be jumped.
+class ScaledClock():
+
+    def __init__(self, speed=1.0, start=None):
+        # Constructor
+        self.speed = float(speed)
+        if start is None:
+            start = time.time()
+        self.start = start
+        self.real_start = time.monotonic()
+        # Total of all jumps, seconds, and of the forward ones
+        self.jumped = 0.0
+        self.jumped_forward = 0.0
+        self.lock = threading.Lock()
+
+    def elapsed(self):
+        return (time.monotonic() - self.real_start) * self.speed
+
+    def time(self):
+        return self.start + self.elapsed() + self.jumped
+
+    def monotonic(self):
+        return VIRTUAL_MONOTONIC_START + self.elapsed() + self.jumped_forward
+
+    def localtime(self, seconds=None):
+        if seconds is None:
+            seconds = self.time()
+        return time.localtime(seconds)
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def advance(self, seconds):
+        """ Jump forward (or back, wall clock only) """
+        self.lock.acquire()
+        try:
+            self.jumped += seconds
+            if seconds > 0:
+                self.jumped_forward += seconds
+        finally:
+            self.lock.release()
+
+    def set_time(self, wall):
+        """ Step the wall clock only """
+        self.lock.acquire()
+        try:
+            self.jumped = wall - self.start - self.elapsed()
+        finally:
+            self.lock.release()
+
+
+# Discrete event clock. Time stands still while any thread using it is
+# busy, and jumps straight to the earliest wake up once every one of
+# them is asleep, so a simulation runs as fast as the code allows.
+# A year of minute by minute schedule checks takes seconds.
+class VirtualClock():
+
+    def __init__(self, start=None):
+        # Constructor
+        if start is None:
+            start = time.time()
+        self.now = float(start)
+        self.mono = VIRTUAL_MONOTONIC_START
+        # Threads that sleep on this clock, and when the sleeping ones wake
+        self.participants = set()
+        self.sleepers = {}
+        self.condition = threading.Condition()
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.mono
+
+    def localtime(self, seconds=None):
+        if seconds is None:
+            seconds = self.now
+        return time.localtime(seconds)
+
+    def sleep(self, seconds):
+        thread = threading.current_thread()
+        self.condition.acquire()
+        try:
+            self.participants.add(thread)
+            wake = self.mono + max(0.0, seconds)
+            self.sleepers[thread] = wake
+            self._advance_if_idle()
+            while self.mono < wake:
+                # Woken by whoever moves the clock, the timeout only
+                # matters when a participant thread has exited
+                self.condition.wait(0.05)
+                self._advance_if_idle()
+            del self.sleepers[thread]
+        finally:
+            self.condition.release()
+
+    def participate(self, thread=None):
+        """ Hold time still while a thread (default the caller) is busy.
+        Threads join by sleeping on the clock, this adds one that has
+        been started but may not have slept yet """
+        if thread is None:
+            thread = threading.current_thread()
+        self.condition.acquire()
+        try:
+            self.participants.add(thread)
+        finally:
+            self.condition.release()
+
+    def leave(self):
+        """ Stop holding time still for the calling thread, e.g. before
+        it waits on something other than this clock """
+        self.condition.acquire()
+        try:
+            self.participants.discard(threading.current_thread())
+            if len(self.sleepers) > 0:
+                self._advance_if_idle()
+        finally:
+            self.condition.release()
+
+    def _advance_if_idle(self):
+        """ Move to the next wake up if no participant is busy.
+        Call with the condition held """
+        self.participants = set(t for t in self.participants if t.is_alive())
+        for thread in self.participants:
+            if thread not in self.sleepers:
+                return
+        wake = min(self.sleepers.values())
+        if wake > self.mono:
+            self.now += wake - self.mono
+            self.mono = wake
+            self.condition.notify_all()
+
+    def advance(self, seconds):
+        """ Jump forward (or back, wall clock only), waking any
+        sleeper that is now due """
+        self.condition.acquire()
+        try:
+            if seconds > 0:
+                self.mono += seconds
+            self.now += seconds
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def set_time(self, wall):
+        """ Step the wall clock, e.g. an NTP correction. Monotonic time
+        and sleepers are not affected """
+        self.condition.acquire()
+        try:
+            self.now = float(wall)
+        finally:
+            self.condition.release()
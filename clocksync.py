@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import time
+import threading
+from collections import deque
+import events
+
+PING_TOPIC = "connection/ping"
+REPLY_TOPIC = "connection/reply"
+# Device whose clock DING play times are given in
+REFERENCE_ID = "doorbell_button"
+# Seconds between offset measurements
+SYNC_INTERVAL = 30.0
+# Measurements kept, the one with the shortest round trip is used
+SYNC_SAMPLES = 8
+
+
+# Estimates the offset between our wall clock and the doorbell button's
+# using the connection/ping and connection/reply exchange, the same way
+# NTP does: offset = t1 - (t0 + t3) / 2, trusting the sample with the
+# shortest round trip the most.
+class ClockSync():
+
+    def __init__(self, client, client_id, reference_id=REFERENCE_ID):
+        # Constructor
+        self.client = client
+        self.client_id = client_id
+        self.reference_id = reference_id
+        # Recent (round trip, offset) samples
+        self.samples = deque(maxlen=SYNC_SAMPLES)
+        # Pings waiting for a reply, seq mapped to t0
+        self.pending = {}
+        self.seq = 0
+        # Reference clock minus our clock, in seconds
+        self.offset = 0.0
+        self.round_trip = None
+        self.synced = False
+        self.lock = threading.Lock()
+        self.exit = False
+        self.thread = None
+
+    def ping(self):
+        """ Send a timed PING """
+        self.lock.acquire()
+        try:
+            self.seq += 1
+            seq = self.seq
+            t0 = time.time()
+            self.pending[seq] = t0
+            # Replies that never arrive must not build up
+            for old in [s for s in self.pending if s < seq - SYNC_SAMPLES]:
+                del self.pending[old]
+        finally:
+            self.lock.release()
+        self.client.publish(
+            PING_TOPIC,
+            events.encode("PING", seq=seq, t0=t0, **{"from": self.client_id})
+        )
+
+    def handle_reply(self, payload):
+        """ Feed a connection/reply payload. Returns True if it was ours """
+        t3 = time.time()
+        name, fields = events.decode(payload)
+        if name != self.reference_id or fields.get("to") != self.client_id:
+            return False
+        try:
+            seq = int(fields["seq"])
+        except (KeyError, ValueError):
+            return False
+        t1 = events.field_float(fields, "t1")
+        self.lock.acquire()
+        try:
+            t0 = self.pending.pop(seq, None)
+            if t0 is None or t1 is None:
+                return True
+            round_trip = t3 - t0
+            self.samples.append((round_trip, t1 - (t0 + t3) / 2.0))
+            # Shortest round trip has the least queuing error
+            self.round_trip, self.offset = min(self.samples)
+            self.synced = True
+        finally:
+            self.lock.release()
+        return True
+
+    def to_local(self, reference_time):
+        """ Convert a time on the reference clock to our wall clock """
+        return reference_time - self.offset
+
+    def to_reference(self, local_time):
+        """ Convert a time on our wall clock to the reference clock """
+        return local_time + self.offset
+
+    def monotonic_for(self, reference_time):
+        """ Our monotonic clock reading for a time on the reference clock """
+        return time.monotonic() + (self.to_local(reference_time) - time.time())
+
+    def start(self, interval=SYNC_INTERVAL):
+        """ Measure now, then keep measuring in the background """
+        self.thread = threading.Thread(target=self.run, args=(interval,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, interval):
+        # A few quick samples first so we are synced soon after start up
+        for n in range(3):
+            if self.exit:
+                return
+            self.ping()
+            time.sleep(1.0)
+        while not self.exit:
+            time.sleep(interval)
+            self.ping()
+
+    def stop(self):
+        self.exit = True
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# Run the doorbell button, ringer and porchlight in a single process.
+# They talk over an in-process event bus, so a ring reaches the ringer
+# without a round trip through mosquitto. Everything is still mirrored
+# to the broker for phone apps and remote ringers.
+import threading
+import RPi.GPIO as GPIO
+import eventbus
+import doorbell_button
+import doorbell_ringer
+import porchlight
+
+
+def main():
+    bus = eventbus.EventBus(mirror=True)
+
+    # Subscribers first, so the first ring has somewhere to go.
+    # The ringer's audio and the light strips start up side by side
+    ringers = []
+    ringer_thread = threading.Thread(target=lambda: ringers.append(
+        doorbell_ringer.DoorBell_Ringer(
+            client=bus.local_client(doorbell_ringer.MQTT_CLIENT_ID)
+        )
+    ))
+    ringer_thread.start()
+    lights = porchlight.PorchLight(
+        client=bus.local_client(porchlight.MQTT_CLIENT_ID)
+    )
+    ringer_thread.join()
+    if len(ringers) == 0:
+        raise RuntimeError("Ringer failed to start")
+    doorbell = doorbell_button.DoorBell_Button(
+        GPIO, client=bus.local_client(doorbell_button.MQTT_CLIENT_ID)
+    )
+
+    button_thread = threading.Thread(target=doorbell.run)
+    button_thread.daemon = True
+    button_thread.start()
+
+    try:
+        rc = lights.run()
+        lights.log.info("rc: {}", rc)
+    except:
+        # Quitting, ensure lights are off
+        for item in lights.channel:
+            # Turn light OFF
+            item.switch_off()
+        lights.set_exit()
+    finally:
+        doorbell.killed = True
+        bus.stop()
+
+
+if __name__ == "__main__":
+    main()
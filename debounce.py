@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+import time
+import threading
+
+# Events returned by the debouncer
+EVENT_PRESS = "press"
+EVENT_RELEASE = "release"
+EVENT_STUCK = "stuck"
+
+
+class Debouncer():
+
+    def __init__(self, settle_time=0.05, min_hold=0.02, repeat_gap=1.0,
+                 stuck_limit=30.0):
+        # Constructor
+        # Edges within this many seconds of the last accepted
+        # transition are treated as contact bounce and ignored
+        self.settle_time = settle_time
+        # Button must be held at least this long for a press to count,
+        # 0 accepts the press on its rising edge
+        self.min_hold = min_hold
+        # Minimum time between two accepted presses
+        self.repeat_gap = repeat_gap
+        # Held longer than this and the button is considered stuck
+        self.stuck_limit = stuck_limit
+
+        # Debounced state, pressed is set on the rising edge and
+        # confirmed once the pin has stayed high for min_hold
+        self.pressed = False
+        self.confirmed = False
+        self.stuck = False
+        # Monotonic time of the last accepted transitions
+        self.time_pressed = None
+        self.time_released = None
+        # Monotonic time of the last confirmed press
+        self.time_confirmed = None
+        # Counters, handy when tuning the settings above
+        self.bounces_ignored = 0
+        self.presses_ignored = 0
+        # Thread lock, GPIO callbacks arrive on their own thread
+        self.lock = threading.Lock()
+
+    def now(self):
+        """ Time source used for all debounce decisions """
+        # Monotonic, so NTP adjustments can not move it
+        return time.monotonic()
+
+    def edge(self, level, now=None):
+        """ Feed a raw pin level read on an edge.
+        Returns EVENT_PRESS, EVENT_RELEASE or None """
+        if now is None:
+            now = self.now()
+        self.lock.acquire()
+        try:
+            if level:
+                return self._rising(now)
+            else:
+                return self._falling(now)
+        finally:
+            self.lock.release()
+
+    def poll(self, level, now=None):
+        """ Periodic check of the settled pin level. Confirms presses
+        held for min_hold, catches releases whose edge was swallowed as
+        bounce, and stuck buttons.
+        Returns EVENT_PRESS, EVENT_RELEASE, EVENT_STUCK or None """
+        if now is None:
+            now = self.now()
+        self.lock.acquire()
+        try:
+            if not self.pressed:
+                if not level and self.stuck:
+                    # Stuck button finally let go
+                    self.stuck = False
+                return None
+            held = now - self.time_pressed
+            if not self.confirmed:
+                if level and held >= self.min_hold:
+                    return self._confirm()
+                if not level and held >= self.settle_time:
+                    # Let go before min_hold, too short to be a press
+                    return self._drop(now)
+                return None
+            if not level and held >= self.settle_time:
+                # Pin has settled low but no release was accepted
+                return self._release(now)
+            if level and held >= self.stuck_limit:
+                # Treat as released, but remember so we do not
+                # send a second release when the contact finally opens
+                self.pressed = False
+                self.confirmed = False
+                self.stuck = True
+                self.time_released = now
+                return EVENT_STUCK
+            return None
+        finally:
+            self.lock.release()
+
+    def deadline(self):
+        """ Monotonic time poll() should next be called to confirm
+        the current press, or None if no press is waiting """
+        self.lock.acquire()
+        try:
+            if not self.pressed or self.confirmed:
+                return None
+            return self.time_pressed + self.min_hold
+        finally:
+            self.lock.release()
+
+    def _settling(self, now):
+        """ Is an edge at this time still within the bounce window """
+        last = self.time_pressed
+        if self.time_released is not None and (
+            last is None or self.time_released > last
+        ):
+            last = self.time_released
+        return last is not None and (now - last) < self.settle_time
+
+    def _rising(self, now):
+        """ Raw rising edge """
+        if self.pressed or self.stuck:
+            return None
+        if self._settling(now):
+            self.bounces_ignored += 1
+            return None
+        if (
+            self.time_confirmed is not None
+            and (now - self.time_confirmed) < self.repeat_gap
+        ):
+            self.presses_ignored += 1
+            return None
+        self.pressed = True
+        self.time_pressed = now
+        if self.min_hold <= 0:
+            return self._confirm()
+        return None
+
+    def _falling(self, now):
+        """ Raw falling edge """
+        if self.stuck:
+            # Stuck button has been released, nothing to send
+            self.stuck = False
+            self.time_released = now
+            return None
+        if not self.pressed:
+            return None
+        held = now - self.time_pressed
+        if held < self.settle_time:
+            # Bounce on press, poll() will pick up a genuine release
+            self.bounces_ignored += 1
+            return None
+        if not self.confirmed:
+            return self._drop(now)
+        return self._release(now)
+
+    def _confirm(self):
+        """ Accept the current press """
+        self.confirmed = True
+        self.time_confirmed = self.time_pressed
+        return EVENT_PRESS
+
+    def _drop(self, now):
+        """ Forget a press released before min_hold """
+        self.pressed = False
+        self.time_released = now
+        self.presses_ignored += 1
+        return None
+
+    def _release(self, now):
+        """ Accept a release """
+        self.pressed = False
+        self.confirmed = False
+        self.time_released = now
+        return EVENT_RELEASE
@@ -1,35 +1,99 @@
-import time
+import queue
 import threading
 import RPi.GPIO as GPIO
-# import context  # Ensures paho is in PYTHONPATH
-import paho.mqtt.client as mqtt
-import porchlight
+import transport
+import debounce
+import metrics
+import events
+import outbox
+import presslog
+import tracing
+import clocks
+import ratelimit
+import inputs
 
 MQTT_CLIENT_ID = "doorbell_button"
-MQTT_SUB_TOPIC = [("connection/ping", 1)]
-MQTT_PUB_TOPIC = [("event/doorbell", 1), ("event/doorbell_app", 1), ("connection/reply", 1)]
-MQTT_HOST = "localhost"
-MQTT_PORT = 1883
-MQTT_KEEPALIVE = 120
-MQTT_USER = ""
-MQTT_PASS = ""
+MQTT_SUB_TOPIC = [("connection/ping", 1), ("query/doorbell_button/presses", 1)]
+MQTT_PUB_TOPIC = [("event/doorbell", 1), ("event/doorbell_app", 1), ("connection/reply", 1), ("status/doorbell_button/latency", 1), ("query/doorbell_button/presses/reply", 1), ("status/doorbell_button/suppressed", 1), ("status/doorbell_button/inputs", 1), ("status/doorbell_button/startup", 1)]
+# Outbound events are kept here until the broker has them
+QUEUE_FILE = "/home/pi/DoorBell/outbound.queue"
+QUEUE_CAPACITY = 256
+# History of presses, one file per day
+PRESS_LOG_FOLDER = "/home/pi/DoorBell/presses/"
+# Ringers play this many seconds after the press, all at once.
+# Gives every ringer time to receive the event. 0 plays on arrival
+SYNC_PLAY_DELAY = 0.15
+# Doorbell inputs, each a dict of any settings in inputs.INPUT_DEFAULTS,
+# e.g. add {"name": "back", "pin": 24, "topic": "event/doorbell/back", "tune": "gate"}
+INPUTS = [{"name": "front", "pin": 23, "topic": "event/doorbell"}]
+# JSON list of inputs used in place of INPUTS, if it exists
+INPUTS_FILE = "/home/pi/DoorBell/inputs.json"
 
 class DoorBell_Button():
-    def __init__(self, GPIO):
-        """ Initialise memeber variables """
-        self.pin_button = 23
-
-        self.time_pressed_last = time.time()
-        self.time_released_last = time.time()
-        # time gap in seconds
-        self.time_gap = 1.0
+    def __init__(self, GPIO, client=None, clock=None):
+        """ Initialise memeber variables.
+        Pass an eventbus client to run in co-located mode,
+        and a virtual clock to run faster than real time """
+        # Time from process start to presses being caught
+        self.startup = metrics.StartupTimer(MQTT_CLIENT_ID)
+        self.clock = clock
+        if self.clock is None:
+            self.clock = clocks.SYSTEM_CLOCK
+        # Every input, each with its own pin, debounce settings,
+        # topic and tune. The first is the front door
+        self.inputs = inputs.load_inputs(INPUTS_FILE, INPUTS)
+        self.pin_inputs = dict((item.pin, item) for item in self.inputs)
+        # Raw edges from the GPIO callback thread, as (input, level,
+        # edge time), all handled by the run loop. Adding inputs adds
+        # no threads or connections
+        self.edges = queue.SimpleQueue()
+
+        # How often the run loop re-checks the settled pin levels
+        self.poll_interval = 0.1
         # List of dings and dongs
         self.playing = []
         self.limit_number = 4
-        # max time allowed for holding button
-        self.time_held_limit = 1
-        self.isPressed = False
-        self.veto_release = False
+        # Rings per second allowed from each input, and how many can be
+        # saved up. Backs up the debounce gap against a faulty or
+        # shorted button. All inputs together get twice that
+        self.ring_rate = 0.5
+        self.ring_burst = 3
+        self.limiter = ratelimit.RateLimiter(
+            self.ring_rate * 2, self.ring_burst * 2,
+            self.ring_rate, self.ring_burst, clock=self.clock
+        )
+
+        # Edge to publish latency (publish call returned)
+        self.latency_publish = metrics.LatencyRecorder("edge_to_publish")
+        # Edge to broker acknowledgement latency (QoS 1 PUBACK)
+        self.latency_ack = metrics.LatencyRecorder("edge_to_ack")
+        # Queue sequence numbers mapped to their edge time
+        self.edge_times = {}
+        # Queue sequence numbers of traced rings mapped to
+        # [trace ID, wall time published]
+        self.traces = {}
+
+        # Disk backed queue of outbound events
+        self.outbox = outbox.Outbox(QUEUE_FILE, QUEUE_CAPACITY)
+        # Max messages published but not yet acknowledged
+        self.inflight_window = 10
+        if client is not None:
+            # Local subscribers get each event on publish, but the ack
+            # waits for the broker. Dont let an outage hold back rings
+            # for the co-located ringer
+            self.inflight_window = QUEUE_CAPACITY
+        # MQTT message ids mapped to queue sequence numbers
+        self.inflight = {}
+        # Acks that arrived before publish() returned their mid
+        self.early_acks = {}
+        self.outbox_lock = threading.Lock()
+        self.drain_lock = threading.Lock()
+        self.drain_again = False
+
+        # History of presses on every input, written on release
+        self.press_log = presslog.PressLog(PRESS_LOG_FOLDER)
+        # Held while a press history query is answered
+        self.query_lock = threading.Lock()
 
         self.GPIO = GPIO
 
@@ -37,111 +101,335 @@ class DoorBell_Button():
         self.GPIO.setmode(self.GPIO.BCM)
 
         # Set GPIO pins appropriately
-        self.GPIO.setup(
-            self.pin_button,
-            self.GPIO.IN,
-            pull_up_down=self.GPIO.PUD_DOWN
-        )
-        self.GPIO.add_event_detect(
-            self.pin_button,
-            self.GPIO.BOTH,
-            callback=self.button
-        )
+        for item in self.inputs:
+            self.GPIO.setup(
+                item.pin,
+                self.GPIO.IN,
+                pull_up_down=self.GPIO.PUD_DOWN
+            )
+            self.GPIO.add_event_detect(
+                item.pin,
+                self.GPIO.BOTH,
+                callback=self.button
+            )
+        # Presses are queued from here on, whether or not connected
+        self.startup.mark("ready")
 
         self.killed = False
-        self.client = mqtt.Client(MQTT_CLIENT_ID, clean_session=False)  # Create a MQTT client object
-        self.client.on_message = self.on_message
-        self.client.on_connect = self.on_connect
-        self.client.on_publish = self.on_publish
-        self.client.on_subscribe = self.on_subscribe
-
-        self.client.username_pw_set(MQTT_USER, MQTT_PASS)
-        self.client.connect(MQTT_HOST, MQTT_PORT, MQTT_KEEPALIVE)  # Connect to the test MQTT broker
-        self.client.loop_start()
-
-    def on_connect(self, mqttc, obj, flags, rc):
-        print("Connected, rc: "+str(rc))
-        self.client.subscribe(MQTT_SUB_TOPIC)
-
-    def on_message(self, mqttc, obj, message):
-        """ Message received. Do something  """
-        print(message.topic+" "+str(message.qos)+" "+str(message.payload))
-        topic = str(message.topic)
-        message = str(message.payload.decode("utf-8"))
-        if topic == MQTT_SUB_TOPIC[0][0]:
-            if message == "PING":
-                print("MQTT Ping request")
-                self.client.publish(MQTT_PUB_TOPIC[2][0], MQTT_CLIENT_ID)
-
-    def on_publish(self, mqttc, obj, mid):
-        print("mid: "+str(mid))
-
-    def on_subscribe(self, mqttc, obj, mid, granted_qos):
-        print("Subscribed: "+str(mid)+" "+str(granted_qos))
-
-    def on_log(self, mqttc, obj, level, string):
-        print(string)
+        # MQTT Initialisation
+        self.transport = transport.Transport(MQTT_CLIENT_ID, client)
+        self.log = self.transport.log
+        self.transport.subscribe(MQTT_SUB_TOPIC[0][0], self.on_ping)
+        self.transport.subscribe(MQTT_SUB_TOPIC[1][0], self.on_query)
+        self.transport.connect_hooks.append(self.on_connect)
+        self.transport.publish_hook = self.on_publish
+        # Span timings of traced rings, we are the reference clock
+        self.tracer = tracing.Tracer(self.transport, MQTT_CLIENT_ID)
+        # Dont block on the broker, presses are queued until it is up.
+        # The network thread keeps retrying with backoff.
+        self.transport.start()
+        self.log.info("Ready in {:.2f}s", self.startup.mark("ready"))
+
+    def connected(self):
+        return self.transport.connected
+
+    def on_connect(self):
+        self.startup.mark("mqtt")
+        if self.startup.complete(["ready", "mqtt"]):
+            summary = self.startup.format_summary()
+            self.log.info("Started, {}", summary)
+            self.transport.publish(MQTT_PUB_TOPIC[7][0], summary, retain=True)
+        # Ringers decode the tunes of our inputs before they are rung
+        self.transport.publish(MQTT_PUB_TOPIC[6][0], self.format_inputs(), retain=True)
+        if len(self.outbox) > 0:
+            self.log.info("Sending {} queued events", len(self.outbox))
+        self.drain()
+
+    def on_ping(self, topic, message, raw):
+        """ connection/ping received """
+        message, fields = events.decode(message)
+        if message == "PING":
+            # Timed pings get our clock reading, for ringer sync
+            self.transport.publish(MQTT_PUB_TOPIC[2][0], events.ping_reply(MQTT_CLIENT_ID, fields, self.clock.time()))
+
+    def on_query(self, topic, message, raw):
+        """ Press history query received """
+        # Scanning the log can take a while, keep the MQTT thread free.
+        # One query at a time, so a flood of them can not pin the CPU
+        if not self.query_lock.acquire(False):
+            self.transport.publish(MQTT_PUB_TOPIC[4][0], "ERROR busy")
+            return
+        threading.Thread(target=self.answer_query, args=(message,)).start()
+
+    def answer_query(self, request):
+        """ Reply to a press history query, e.g. "HOURLY 30" """
+        try:
+            reply = self.press_log.query(request)
+        finally:
+            self.query_lock.release()
+        self.transport.publish(MQTT_PUB_TOPIC[4][0], reply)
+
+    def on_publish(self, mid):
+        time_now = self.clock.monotonic()
+        self.outbox_lock.acquire()
+        try:
+            seq = self.inflight.pop(mid, None)
+            if seq is None:
+                # publish() has not returned yet, let drain() handle it.
+                # Acks for messages outside the queue are never claimed,
+                # so forget anything older than a few seconds.
+                for old in [m for m, t in self.early_acks.items() if time_now - t > 5.0]:
+                    del self.early_acks[old]
+                self.early_acks[mid] = time_now
+                return
+        finally:
+            self.outbox_lock.release()
+        self.acknowledged(seq, time_now)
+        # Window has room, send the next batch
+        self.drain()
+
+    def acknowledged(self, seq, time_ack):
+        """ Broker has a queued event, release it """
+        self.outbox.ack(seq)
+        self.outbox_lock.acquire()
+        try:
+            time_edge = self.edge_times.pop(seq, None)
+            trace = self.traces.pop(seq, None)
+        finally:
+            self.outbox_lock.release()
+        if trace is not None and trace[1] is not None:
+            self.tracer.span(trace[0], "ack", trace[1], tracing.wall_time(time_ack, self.clock.time(), self.clock.monotonic()))
+        if time_edge is not None:
+            # Ring has now definitely left the Pi
+            self.latency_ack.record(time_ack - time_edge)
+            self.publish_latency()
+
+    def publish_latency(self):
+        """ Publish a retained latency summary """
+        summary = "{} | {}".format(
+            self.latency_publish.format_summary(),
+            self.latency_ack.format_summary()
+        )
+        self.log.debug("{}", summary)
+        if self.connected():
+            self.transport.publish(MQTT_PUB_TOPIC[3][0], summary, retain=True)
 
     def run(self):
         """ Starting method. Listen for doorbell button
-        press and inform all MQTT clients listening. """
+        presses and inform all MQTT clients listening. """
+        time_poll = self.clock.monotonic()
         while True:
             # Check exit flag on each loop
             if self.killed:
                 return
+            # Wake for the next poll, or sooner to confirm a held press
+            time_wake = time_poll + self.poll_interval
+            for item in self.inputs:
+                deadline = item.debouncer.deadline()
+                if deadline is not None:
+                    time_wake = min(time_wake, deadline)
+            edge = self.next_edge(max(0.0, time_wake - self.clock.monotonic()))
+            if edge is not None:
+                self.handle_edge(*edge)
+            time_now = self.clock.monotonic()
+            if time_now >= time_poll + self.poll_interval:
+                time_poll = time_now
+                for item in self.inputs:
+                    self.poll(item, time_now)
             else:
-                # Dont run at 100% wasting CPU
-                time.sleep(1)
+                for item in self.inputs:
+                    deadline = item.debouncer.deadline()
+                    if deadline is not None and time_now >= deadline:
+                        self.poll(item, time_now)
+
+    def next_edge(self, timeout):
+        """ Wait up to timeout for the next queued edge, or None """
+        try:
+            if self.clock is clocks.SYSTEM_CLOCK:
+                return self.edges.get(True, timeout)
+            # A virtual clock can not be waited on through the queue
+            return self.edges.get_nowait()
+        except queue.Empty:
+            if self.clock is not clocks.SYSTEM_CLOCK:
+                self.clock.sleep(timeout)
+            return None
+
+    def poll(self, item, time_now):
+        """ Confirm held presses, catch releases lost as bounce
+        and stuck buttons. Cheap enough to not waste CPU """
+        pin_value = self.GPIO.input(item.pin)
+        event = item.debouncer.poll(pin_value, time_now)
+        if event == debounce.EVENT_PRESS:
+            # Timed from the rising edge, not from the confirmation
+            self.buttonPressed(item, item.debouncer.time_pressed)
+        elif event == debounce.EVENT_RELEASE:
+            self.buttonReleased(item, time_now)
+        elif event == debounce.EVENT_STUCK:
+            self.log.warning("Button {} held over {}s, treating as stuck",
+                item.name, item.debouncer.stuck_limit)
+            # The real release is vetoed by the debouncer
+            self.buttonReleased(item, time_now)
+
+    def queue_publish(self, topic, payload, time_edge=None, wall=None, trace_id=None):
+        """ Append an event to the outbound queue and try to send it """
+        if wall is None:
+            wall = self.clock.time()
+        mono = time_edge
+        if mono is None:
+            mono = self.clock.monotonic()
+        seq = self.outbox.append(topic, payload, mono, wall)
+        if time_edge is not None or trace_id is not None:
+            self.outbox_lock.acquire()
+            try:
+                if time_edge is not None:
+                    self.edge_times[seq] = time_edge
+                if trace_id is not None:
+                    self.traces[seq] = [trace_id, None]
+            finally:
+                self.outbox_lock.release()
+        self.drain()
+        return seq
+
+    def drain(self):
+        """ Publish queued events, a window at a time """
+        if not self.connected():
+            return
+        # Only one thread drains, any other just asks it to go round again
+        if not self.drain_lock.acquire(False):
+            self.drain_again = True
+            return
+        try:
+            self.drain_again = True
+            while self.drain_again and self.connected():
+                self.drain_again = False
+                room = self.inflight_window - self.outbox.in_flight()
+                if room <= 0:
+                    break
+                for record in self.outbox.unsent(room):
+                    info = self.transport.publish(record.topic, record.payload, qos=1)
+                    if info.rc not in (transport.MQTT_ERR_SUCCESS, transport.MQTT_ERR_NO_CONN):
+                        # Not handed over, try again on the next drain
+                        return
+                    # paho owns it now. Its session (clean_session=False)
+                    # resends anything unacknowledged after a reconnect,
+                    # under the same mid. The outbox only sends again
+                    # after a restart
+                    self.outbox.mark_sent(record.seq)
+                    time_published = self.clock.time()
+                    self.outbox_lock.acquire()
+                    try:
+                        time_ack = self.early_acks.pop(info.mid, None)
+                        if time_ack is None:
+                            self.inflight[info.mid] = record.seq
+                        time_edge = self.edge_times.get(record.seq)
+                        # Traced the first time it is published only
+                        trace = self.traces.get(record.seq)
+                        if trace is not None and trace[1] is None:
+                            trace[1] = time_published
+                        else:
+                            trace = None
+                    finally:
+                        self.outbox_lock.release()
+                    if time_edge is not None:
+                        self.latency_publish.record(self.clock.monotonic() - time_edge)
+                    if trace is not None:
+                        # Edge (or press) to publish returned
+                        self.tracer.span(trace[0], "button", tracing.wall_time(record.mono, time_published, self.clock.monotonic()), time_published)
+                    if time_ack is not None:
+                        self.acknowledged(record.seq, time_ack)
+                        self.drain_again = True
+        finally:
+            self.drain_lock.release()
+
+    def play_time(self, wall):
+        """ Time (on our clock) every ringer should start playing """
+        if SYNC_PLAY_DELAY <= 0:
+            return None
+        return wall + SYNC_PLAY_DELAY
 
-    def Ding(self):
+    def Ding(self, item, time_edge=None):
         """ Button pressed """
         # Send DING to all sockets
-        print("Ding Sending")
-        self.client.publish(MQTT_PUB_TOPIC[0][0], "DING")
-        self.client.publish(MQTT_PUB_TOPIC[1][0], "DOORBELL")  # Separate single event for mobile MQTT apps
+        wall = self.clock.time()
+        trace_id = tracing.new_trace_id()
+        self.queue_publish(item.topic, self.stamp(events.EVENT_DING, item, wall, trace_id), time_edge, wall, trace_id)
+        self.queue_publish(MQTT_PUB_TOPIC[1][0], "DOORBELL", None, wall)  # Separate single event for mobile MQTT apps
+        self.log.info("Ding {}", item.name)
+        # Remember the press so it can be logged once released
+        item.press_wall = wall
+        item.press_edge = time_edge
+        item.press_latency = -1.0
+        if time_edge is not None and self.connected():
+            item.press_latency = self.clock.monotonic() - time_edge
 
-    def Dong(self):
+    def Dong(self, item, time_edge=None):
         """ Button released """
-        # Send DING to all sockets
-        self.client.publish(MQTT_PUB_TOPIC[0][0], "DONG")  # Turn the AC unit on
+        # Send DONG to all sockets
+        wall = self.clock.time()
+        trace_id = tracing.new_trace_id()
+        self.queue_publish(item.topic, self.stamp(events.EVENT_DONG, item, wall, trace_id), time_edge, wall, trace_id)
+        self.log_press(item, time_edge)
+
+    def stamp(self, name, item, wall, trace_id):
+        """ DING/DONG payload for an input. Each input is a
+        separate source, and names its tune if it has one """
+        return events.stamp(
+            name, wall, at=self.play_time(wall), tid=trace_id,
+            src="{}/{}".format(MQTT_CLIENT_ID, item.name), tune=item.tune
+        )
+
+    def format_inputs(self):
+        """ Tune of every input, - for the ringer's own selection """
+        tunes = dict((item.name, item.tune or "-") for item in self.inputs)
+        return events.encode("INPUTS", **tunes)
+
+    def log_press(self, item, time_edge=None):
+        """ Append the finished press to the press history """
+        if item.press_wall is None:
+            return
+        held = 0.0
+        if time_edge is not None and item.press_edge is not None:
+            held = time_edge - item.press_edge
+        self.press_log.append(item.press_wall, held, item.press_latency)
+        item.press_wall = None
 
     def button(self, channel):
         """ Button has been either pressed or released
         Its a rising or falling edge, check pin value to see which """
-        pin_value = self.GPIO.input(self.pin_button)
-        if (pin_value):
-            self.buttonPressed(channel)
-        else:
-            self.buttonReleased(channel)
+        # Timestamp the edge before anything else, then hand it to the
+        # run loop so this GPIO thread is never held up
+        time_edge = self.clock.monotonic()
+        item = self.pin_inputs.get(channel)
+        if item is None:
+            return
+        self.edges.put((item, self.GPIO.input(channel), time_edge))
+
+    def handle_edge(self, item, pin_value, time_edge):
+        """ Debounce an edge queued by the GPIO callback """
+        event = item.debouncer.edge(pin_value, time_edge)
+        if event == debounce.EVENT_PRESS:
+            self.buttonPressed(item, time_edge)
+        elif event == debounce.EVENT_RELEASE:
+            self.buttonReleased(item, time_edge)
 
-    def buttonPressed(self, channel):
+    def buttonPressed(self, item, time_edge=None):
         """ Button pressed """
-        time_now = time.time()
-        time_diff = time_now - self.time_pressed_last
-        if (time_diff >= self.time_gap):
-            # Time since previous press is longer than min gap
-            self.isPressed = True
-            # self.AppendDateToFile()
-            self.Ding()
-            # Remember last successful button press
-            self.time_pressed_last = time_now
-
-    def buttonReleased(self, channel):
+        if not self.limiter.allow(item.name):
+            item.ring_suppressed = True
+            summary = self.limiter.format_summary()
+            self.log.warning("Too many presses, {}", summary)
+            if self.connected():
+                self.transport.publish(MQTT_PUB_TOPIC[5][0], summary, retain=True)
+            return
+        item.ring_suppressed = False
+        self.Ding(item, time_edge)
+
+    def buttonReleased(self, item, time_edge=None):
         """ Button released """
-        time_now = time.time()
-        time_diff = time_now - self.time_released_last
-        if (
-            time_diff >= self.time_gap and
-            not self.veto_release and
-            self.isPressed
-        ):
-            # Time since previous press is longer than min gap
-            self.isPressed = False
-            self.Dong()
-            # Remember last successful button press
-            self.time_released_last = time_now
-        # Reset variable
-        self.veto_release = False
+        if item.ring_suppressed:
+            item.ring_suppressed = False
+            return
+        self.Dong(item, time_edge)
 
 
 if __name__=="__main__":
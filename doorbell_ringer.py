@@ -1,98 +1,284 @@
-import os
 import time
-import subprocess
-import paho.mqtt.client as mqtt # Import the MQTT library
+import threading
+import transport
+import events
+import audio
+import soundlibrary
+import clocksync
+import tracing
+import metrics
+import ratelimit
 
 MQTT_CLIENT_ID = "front_door_ringer"
-MQTT_TOPIC = [("event/doorbell", 1), ("connection/ping", 1)]
-MQTT_HOST = "localhost"
-MQTT_PORT = 1883
-MQTT_KEEPALIVE = 120
-MQTT_USER = ""
-MQTT_PASS = ""
+MQTT_TOPIC = [("event/doorbell", 1), ("connection/ping", 1), ("event/doorbell_tune", 1), ("connection/reply", 1), ("event/doorbell/+", 1), ("status/doorbell_button/inputs", 1)]
+MQTT_STATUS_TOPIC = "status/front_door_ringer/tune"
+MQTT_EXPIRED_TOPIC = "status/front_door_ringer/expired"
+MQTT_SUPPRESSED_TOPIC = "status/front_door_ringer/suppressed"
+MQTT_STARTUP_TOPIC = "status/front_door_ringer/startup"
 SOUNDS_FOLDER = "/home/pi/DoorBell/sounds/"
+# "" picks the best available output, or "alsa", "aplay", "null", "file:/tmp/out.wav"
+AUDIO_SINK = ""
+# Tune set to start with, "AUTO" follows the seasons
+DEFAULT_TUNE_SET = soundlibrary.AUTO_SET
+# Rings scheduled further ahead than this (seconds) play straight away,
+# the clocks must be badly out
+MAX_SCHEDULE_AHEAD = 2.0
+# DING/DONGs older than this (seconds) are dropped unplayed
+EVENT_TTL = events.EVENT_TTL
+# Ring flood control, DING/DONGs per second (and burst) in total and
+# from any one source (src field). A press is a DING and a DONG
+RING_RATE = 4.0
+RING_BURST = 10
+RING_SOURCE_RATE = 2.0
+RING_SOURCE_BURST = 6
+# Seconds between reports of suppressed rings during a flood
+SUPPRESSED_REPORT_INTERVAL = 5.0
 
 class DoorBell_Ringer:
-    def __init__(self):
-        """ Initialise member variables """
-        self.playing = []  # List of dings and dongs
+    def __init__(self, client=None, sink=None):
+        """ Initialise member variables.
+        Pass an eventbus client to run in co-located mode,
+        and an audio sink to play somewhere other than the speaker """
+        # Time from process start to ready to ring
+        self.startup = metrics.StartupTimer(MQTT_CLIENT_ID)
         self.limit_number = 4
-        self.selected_ding = "ding.wav"
-        self.selected_dong = "dong.wav"
         self.killed = False
+        self.transport = transport.Transport(MQTT_CLIENT_ID, client)
+        self.log = self.transport.log
+        # Events too old to play, e.g. a backlog after a reconnect
+        self.expired = metrics.DropCounter("expired")
+        # Rings over the flood limits are dropped unplayed
+        self.limiter = ratelimit.RateLimiter(
+            RING_RATE, RING_BURST, RING_SOURCE_RATE, RING_SOURCE_BURST
+        )
+        self.suppressed_reported = None
+        # Set once the sounds and audio output are ready. Rings that
+        # arrive while starting up wait for it
+        self.ready = threading.Event()
+        self.audio = None
+        # Latest tune set selection and input tunes still to apply.
+        # One worker takes them, so a burst of requests neither piles
+        # up threads nor decodes sets already superseded
+        self.tune_request = None
+        self.inputs_request = None
+        self.tune_lock = threading.Lock()
+        self.tune_wake = threading.Event()
+        self.tune_thread = threading.Thread(target=self.tune_worker)
+        self.tune_thread.daemon = True
+        self.tune_thread.start()
+
+        # Offset to the doorbell button's clock, so every ringer in the
+        # house can start a ring at the same instant
+        self.clock = clocksync.ClockSync(self.transport, MQTT_CLIENT_ID)
+        # Span timings of traced rings, on the button's clock
+        self.tracer = tracing.Tracer(self.transport, MQTT_CLIENT_ID, self.clock)
 
         # MQTT Initialisation
-        self.client = mqtt.Client(client_id=MQTT_CLIENT_ID, clean_session=False)
-        self.client.username_pw_set(MQTT_USER, MQTT_PASS)
-        self.client.on_message = self.on_message
-        self.client.on_connect = self.on_connect
-        self.client.on_publish = self.on_publish
-        self.client.on_subscribe = self.on_subscribe
-
-        self.client.connect(MQTT_HOST, MQTT_PORT, MQTT_KEEPALIVE)
-        self.client.loop_start() # Start the MQTT client
-
-    def Ding(self):
-        """ Play Ding Sound """
-        self.processPlaying(self.playing, self.limit_number)
-        filename = SOUNDS_FOLDER + self.selected_ding
-        if self.selected_ding != "" and os.path.isfile(filename):
-            self.playing.append(
-                subprocess.Popen(["/usr/bin/aplay", '-q', filename])
-            )
-
-    def Dong(self):
-        """ Play Dong Sound """
-        self.processPlaying(self.playing, self.limit_number)
-        filename = SOUNDS_FOLDER + self.selected_dong
-        if self.selected_dong != "" and os.path.isfile(filename):
-            self.playing.append(
-                subprocess.Popen(["/usr/bin/aplay", '-q', filename])
-            )
-
-    def processPlaying(self, playing, limit_number):
-        """ Remove finished sound processes and
-            limit sound processes to a set number """
-        count = len(playing)
-        if (count >= limit_number):
-            # Remove the first few until process count is low enough
-            for n in range(0, (count-limit_number)):
-                item = playing[0]
-                if item.poll() is None:
-                    item.terminate()  # Wasnt finished, make it finished
-                playing.pop(0)  # remove first item from list
-
-    def on_connect(self, mqttc, obj, flags, rc):
-        print("Connected, rc: "+str(rc))
-        self.client.subscribe(MQTT_TOPIC)
-
-    def on_message(self, mqttc, obj, message):
-        """ Message received. Do something  """
-        print(message.topic+" "+str(message.qos)+" "+str(message.payload))
-        topic = str(message.topic)
-        message = str(message.payload.decode("utf-8"))
-        if topic == MQTT_TOPIC[0][0]:
-            if message == "DING":
-                # Thin out audio playing list
-                ringer.Ding()
-                print("Ding")
-            if message == "DONG":
-                # Thin out audio playing list
-                ringer.Dong()
-                print("Dong")
-        if topic == MQTT_TOPIC[1][0]:
-            if message == "PING":
-                print("MQTT Ping request")
-                self.client.publish("connection/reply", MQTT_CLIENT_ID)
-
-    def on_publish(self, mqttc, obj, mid):
-        print("mid: "+str(mid))
-
-    def on_subscribe(self, mqttc, obj, mid, granted_qos):
-        print("Subscribed: "+str(mid)+" "+str(granted_qos))
-
-    def on_log(self, mqttc, obj, level, string):
-        print(string)
+        self.transport.subscribe(MQTT_TOPIC[0][0], self.on_doorbell)
+        self.transport.subscribe(MQTT_TOPIC[1][0], self.on_ping)
+        self.transport.subscribe(MQTT_TOPIC[2][0], self.on_tune)
+        self.transport.subscribe(MQTT_TOPIC[3][0], self.on_reply)
+        # The button's other inputs, and the tunes they ring with
+        self.transport.subscribe(MQTT_TOPIC[4][0], self.on_doorbell)
+        self.transport.subscribe(MQTT_TOPIC[5][0], self.on_inputs)
+        self.transport.connect_hooks.append(self.on_connect)
+        # Connect and start syncing clocks while the audio starts up
+        self.transport.start()
+        self.clock.start()
+
+        # Audio Initialisation. Sounds are decoded once and played
+        # from memory through a single persistent output stream.
+        # The output is opened while the tunes decode
+        audio_thread = threading.Thread(target=self.start_audio, args=(sink,))
+        audio_thread.start()
+        # Tune sets, decoded ahead of time and reloaded when changed
+        self.library = soundlibrary.SoundLibrary(SOUNDS_FOLDER)
+        self.library.select(DEFAULT_TUNE_SET)
+        self.startup.mark("tunes")
+        audio_thread.join()
+        if self.audio is None:
+            raise RuntimeError("Audio output failed to start")
+        self.library.watch()
+        self.ready.set()
+        self.log.info("Ready to ring in {:.2f}s", self.startup.mark("ready"))
+        self.report_startup()
+
+    def start_audio(self, sink=None):
+        """ Open the audio output """
+        if sink is None:
+            sink = audio.make_sink(AUDIO_SINK)
+        self.audio = audio.AudioEngine(sink, limit_number=self.limit_number)
+        self.startup.mark("audio")
+
+    def on_connect(self):
+        self.startup.mark("mqtt")
+        self.report_startup()
+
+    def report_startup(self):
+        """ Publish the startup times, retained, once ready and connected """
+        if self.startup.complete(["ready", "mqtt"]):
+            summary = self.startup.format_summary()
+            self.log.info("Started, {}", summary)
+            self.transport.publish(MQTT_STARTUP_TOPIC, summary, retain=True)
+
+    def Ding(self, play_at=None, trace=None, tune=None):
+        """ Play Ding Sound, of the selected set or the given one """
+        self.play(self.library.get_set(tune)[0], play_at, trace)
+
+    def Dong(self, play_at=None, trace=None, tune=None):
+        """ Play Dong Sound, of the selected set or the given one """
+        self.play(self.library.get_set(tune)[1], play_at, trace)
+
+    def play(self, sound, play_at=None, trace=None):
+        """ Play now, or at a time given on the doorbell button's clock.
+        trace is (trace ID, time received) for a traced ring """
+        if sound is None:
+            return
+        on_start = None
+        if trace is not None:
+            on_start = self.trace_audio(trace)
+        if play_at is not None and self.clock.synced:
+            when = self.clock.monotonic_for(play_at)
+            ahead = when - time.monotonic()
+            if 0 < ahead < MAX_SCHEDULE_AHEAD:
+                self.audio.play_at(sound, when, on_start)
+                return
+        # Late, unsynced or unscheduled, play straight away
+        self.audio.play(sound, on_start)
+
+    def trace_audio(self, trace):
+        """ Report the dispatch span now, and the audio span once the
+        first block of the sound has been written """
+        trace_id, time_received = trace
+        time_dispatched = time.time()
+        self.tracer.span(trace_id, "dispatch", time_received, time_dispatched)
+
+        def on_start(time_start):
+            # Includes any wait for a scheduled play time
+            self.tracer.span(trace_id, "audio", time_dispatched, tracing.wall_time(time_start))
+        return on_start
+
+    def select_tunes(self, name):
+        """ Switch tune set, then report what is selected """
+        self.library.select(name)
+        self.transport.publish(
+            MQTT_STATUS_TOPIC,
+            "{} {} sets={}".format(
+                self.library.requested, self.library.selected,
+                ",".join(self.library.set_names())
+            ),
+            retain=True
+        )
+
+    def on_doorbell(self, topic, message, raw):
+        """ Doorbell event received """
+        time_received = time.time()
+        # Only waits for a ring delivered as we start up
+        self.ready.wait()
+        # Event name is the first word, any fields follow
+        message, fields = events.decode(message)
+        # Stamped on the button's clock
+        now = self.clock.to_reference(time_received)
+        if events.expired(fields, EVENT_TTL, now):
+            self.drop_expired(message, events.age(fields, now))
+            return
+        if message in (events.EVENT_DING, events.EVENT_DONG):
+            if not self.limiter.allow(fields.get("src")):
+                self.report_suppressed()
+                return
+        play_at = events.field_float(fields, "at")
+        trace = None
+        trace_id = fields.get(tracing.TRACE_FIELD)
+        if trace_id is not None:
+            trace = (trace_id, time_received)
+            sent = events.field_float(fields, "ts")
+            if sent is not None:
+                # Sent on the button's clock, received on ours
+                self.tracer.span(trace_id, "deliver", self.clock.to_local(sent), time_received)
+        tune = fields.get("tune")
+        if message == "DING":
+            self.Ding(play_at, trace, tune)
+            self.log.info("Ding")
+        if message == "DONG":
+            self.Dong(play_at, trace, tune)
+            self.log.info("Dong")
+
+    def drop_expired(self, name, age):
+        """ Count and report an event too old to play """
+        self.expired.drop(name, age)
+        self.log.info("Dropped {} {:.1f}s old", name, age)
+        self.transport.publish(MQTT_EXPIRED_TOPIC, self.expired.format_summary(), retain=True)
+
+    def report_suppressed(self):
+        """ Report rings over the flood limits, at most every few seconds
+        however fast they arrive """
+        time_now = time.monotonic()
+        if (
+            self.suppressed_reported is not None
+            and time_now - self.suppressed_reported < SUPPRESSED_REPORT_INTERVAL
+        ):
+            return
+        self.suppressed_reported = time_now
+        summary = self.limiter.format_summary()
+        self.log.warning("Ring flood, {}", summary)
+        self.transport.publish(MQTT_SUPPRESSED_TOPIC, summary, retain=True)
+
+    def on_ping(self, topic, message, raw):
+        """ connection/ping received """
+        message, fields = events.decode(message)
+        if message == "PING":
+            self.transport.publish("connection/reply", events.ping_reply(MQTT_CLIENT_ID, fields))
+
+    def on_reply(self, topic, message, raw):
+        """ Replies to our clock sync pings """
+        self.clock.handle_reply(message)
+
+    def on_inputs(self, topic, message, raw):
+        """ Doorbell inputs received, decode the tunes they ring with """
+        message, fields = events.decode(message)
+        tunes = set(tune for tune in fields.values() if tune != "-")
+        # Decoding can take a while, keep the MQTT thread free
+        self.tune_lock.acquire()
+        try:
+            self.inputs_request = sorted(tunes)
+        finally:
+            self.tune_lock.release()
+        self.tune_wake.set()
+
+    def preload_tunes(self, names):
+        """ Decode the tunes of the button's inputs """
+        self.library.preload(names)
+
+    def on_tune(self, topic, message, raw):
+        """ Tune set selection received """
+        # Decoding can take a while, keep the MQTT thread free
+        self.tune_lock.acquire()
+        try:
+            self.tune_request = message
+        finally:
+            self.tune_lock.release()
+        self.tune_wake.set()
+
+    def tune_worker(self):
+        """ Apply the latest tune requests, once ready to ring """
+        self.ready.wait()
+        while True:
+            self.tune_wake.wait()
+            self.tune_wake.clear()
+            self.tune_lock.acquire()
+            try:
+                names, self.inputs_request = self.inputs_request, None
+                name, self.tune_request = self.tune_request, None
+            finally:
+                self.tune_lock.release()
+            try:
+                if names is not None:
+                    self.preload_tunes(names)
+                if name is not None:
+                    self.select_tunes(name)
+            except Exception as e:
+                # Keep taking requests, a later one may well work
+                self.log.error("Tune change failed: {}", e)
 
     def run(self):
         while True:
@@ -153,4 +339,7 @@ if __name__ == "__main__":
     except:
         pass
     finally:
-        ringer.client.loop_stop()
+        ringer.transport.stop()
+        ringer.library.stop()
+        ringer.clock.stop()
+        ringer.audio.stop()
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+import time
+import queue
+import threading
+import paho.mqtt.client as mqtt
+import logger
+import transport
+import events
+import metrics
+
+# Client ID of the bridge mirroring local events to the broker
+MQTT_CLIENT_ID = "doorbell_bus"
+# Seconds a mirrored message is remembered, once the broker has it,
+# to drop its echo
+ECHO_WINDOW = 5.0
+# Stamped events on these topics arriving from the broker older than
+# EVENT_TTL seconds are dropped, not passed to the local daemons
+EXPIRING_TOPICS = ["event/doorbell", "event/doorbell/+", "event/porchlight"]
+EVENT_TTL = events.EVENT_TTL
+
+
+class Message():
+
+    def __init__(self, topic, payload, qos=0, retain=False):
+        # Same attributes the daemons use from a paho MQTTMessage
+        self.topic = topic
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif payload is None:
+            payload = b""
+        elif not isinstance(payload, bytes):
+            payload = str(payload).encode("utf-8")
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = 0
+        # Called once the broker has a mirrored QoS 1 message
+        self.on_mirrored = None
+
+
+class PublishInfo():
+
+    def __init__(self, mid, rc=0):
+        # Same attributes the daemons use from a paho MQTTMessageInfo
+        self.mid = mid
+        self.rc = rc
+
+    def is_published(self):
+        return True
+
+    def wait_for_publish(self, timeout=None):
+        return
+
+
+# Stand in for a paho Client that publishes on the in-process bus.
+# Daemons are handed one of these instead of building their own.
+class LocalClient():
+
+    def __init__(self, bus, client_id):
+        # Constructor
+        self.bus = bus
+        self.client_id = client_id
+        # Same callbacks as paho
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self.on_subscribe = None
+        self.on_log = None
+        self.userdata = None
+        self.next_mid = 0
+        self.lock = threading.Lock()
+
+    def _mid(self):
+        self.lock.acquire()
+        try:
+            self.next_mid += 1
+            return self.next_mid
+        finally:
+            self.lock.release()
+
+    def username_pw_set(self, username, password=None):
+        return
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        return
+
+    def connect(self, host=None, port=None, keepalive=None):
+        """ The bus is always available, connect straight away """
+        if self.on_connect is not None:
+            self.on_connect(self, self.userdata, {}, 0)
+        return 0
+
+    def connect_async(self, host=None, port=None, keepalive=None):
+        return self.connect(host, port, keepalive)
+
+    def loop_start(self):
+        return
+
+    def loop_stop(self, force=False):
+        return
+
+    def disconnect(self):
+        self.bus.unsubscribe_all(self)
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, self.userdata, 0)
+
+    def subscribe(self, topic, qos=0):
+        """ Accepts a topic string or a list of (topic, qos) """
+        if isinstance(topic, (list, tuple)) and not isinstance(topic, str):
+            if len(topic) == 2 and isinstance(topic[1], int) and isinstance(topic[0], str):
+                topics = [topic]
+            else:
+                topics = topic
+        else:
+            topics = [(topic, qos)]
+        for sub, sub_qos in topics:
+            self.bus.subscribe(sub, self)
+        mid = self._mid()
+        if self.on_subscribe is not None:
+            self.on_subscribe(self, self.userdata, mid, tuple(q for t, q in topics))
+        return 0, mid
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """ Deliver to local subscribers now, mirror to MQTT later """
+        mid = self._mid()
+        on_mirrored = None
+        if self.on_publish is not None:
+            def on_mirrored():
+                self.on_publish(self, self.userdata, mid)
+        self.bus.publish(topic, payload, qos, retain, on_mirrored)
+        return PublishInfo(mid)
+
+    def deliver(self, message):
+        """ Called by the bus for each matching message """
+        if self.on_message is not None:
+            self.on_message(self, self.userdata, message)
+
+
+# In-process publish/subscribe bus for running the button, ringer and
+# porchlight in a single process. Local subscribers are called directly
+# in the publishing thread, while a bridge thread mirrors everything to
+# the MQTT broker for phone apps and remote ringers and feeds remote
+# messages back in.
+class EventBus():
+
+    def __init__(self, mirror=True):
+        # Constructor
+        # List of (subscription, LocalClient)
+        self.subscriptions = []
+        # Retained messages by topic, replayed to new subscribers
+        self.retained = {}
+        self.lock = threading.Lock()
+        self.log = logger.get_logger(MQTT_CLIENT_ID)
+        # Stale events from the broker, e.g. a backlog after a reconnect
+        self.expired = metrics.DropCounter("expired")
+        # Local messages waiting to be mirrored to the broker
+        self.outgoing = queue.Queue()
+        # Mirrored messages whose echo is still to come, by topic and
+        # payload: [count, count not yet with the broker, time last
+        # handed over]
+        self.echoes = {}
+        self.echo_lock = threading.Lock()
+        # Bridge mids of mirrored messages the broker does not have
+        # yet, and acks that came before publish() returned
+        self.unacked = {}
+        self.early_acks = {}
+        self.ack_lock = threading.Lock()
+        self.mirror = mirror
+        self.connected = False
+        self.client = None
+        self.mirror_thread = None
+        if self.mirror:
+            self.start_mirror()
+
+    def local_client(self, client_id):
+        """ Build a client for a daemon to use instead of paho """
+        return LocalClient(self, client_id)
+
+    def subscribe(self, sub, client):
+        self.lock.acquire()
+        try:
+            if (sub, client) not in self.subscriptions:
+                self.subscriptions.append((sub, client))
+            retained = [
+                message for topic, message in self.retained.items()
+                if transport.topic_matches(sub, topic)
+            ]
+        finally:
+            self.lock.release()
+        if self.connected:
+            self.client.subscribe(sub, qos=1)
+        for message in retained:
+            client.deliver(message)
+
+    def unsubscribe_all(self, client):
+        self.lock.acquire()
+        try:
+            self.subscriptions = [
+                item for item in self.subscriptions if item[1] is not client
+            ]
+        finally:
+            self.lock.release()
+
+    def dispatch(self, message):
+        """ Deliver a message to every matching local subscriber """
+        self.lock.acquire()
+        try:
+            if message.retain:
+                self.retained[message.topic] = message
+            targets = []
+            for sub, client in self.subscriptions:
+                if client not in targets and transport.topic_matches(sub, message.topic):
+                    targets.append(client)
+        finally:
+            self.lock.release()
+        for client in targets:
+            try:
+                client.deliver(message)
+            except Exception as e:
+                # One broken handler must not stop the others
+                self.log.error("Handler for {} failed: {}", message.topic, e)
+
+    def publish(self, topic, payload=None, qos=0, retain=False, on_mirrored=None):
+        """ Publish locally, then queue for mirroring to the broker.
+        on_mirrored is called once delivery is complete: when the
+        broker acknowledges a mirrored QoS 1 message, otherwise as
+        soon as local subscribers have it """
+        message = Message(topic, payload, qos, retain)
+        self.dispatch(message)
+        if self.mirror and qos > 0:
+            # The button keeps the event on disk until this is called,
+            # so it survives a broker outage and a restart
+            message.on_mirrored = on_mirrored
+        elif on_mirrored is not None:
+            on_mirrored()
+        if self.mirror:
+            self.outgoing.put(message)
+
+    # ---- MQTT mirror ----
+
+    def start_mirror(self):
+        """ Connect the bridge client without blocking start up """
+        self.client = mqtt.Client(client_id=MQTT_CLIENT_ID, clean_session=False)
+        self.client.username_pw_set(transport.MQTT_USER, transport.MQTT_PASS)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+        self.client.on_publish = self.on_publish
+        self.client.reconnect_delay_set(
+            transport.MQTT_RECONNECT_MIN, transport.MQTT_RECONNECT_MAX)
+        self.client.connect_async(
+            transport.MQTT_HOST, transport.MQTT_PORT, transport.MQTT_KEEPALIVE)
+        self.client.loop_start()
+        self.mirror_thread = threading.Thread(target=self.mirror_loop)
+        self.mirror_thread.daemon = True
+        self.mirror_thread.start()
+
+    def stop(self):
+        if self.mirror:
+            self.outgoing.put(None)
+            self.client.loop_stop()
+
+    def on_connect(self, mqttc, obj, flags, rc):
+        if rc != 0:
+            self.log.warning("Bus bridge connect refused, rc: {}", rc)
+            return
+        self.log.info("Bus bridge connected")
+        self.connected = True
+        self.lock.acquire()
+        try:
+            subs = list(set(sub for sub, client in self.subscriptions))
+        finally:
+            self.lock.release()
+        if len(subs) > 0:
+            self.client.subscribe([(sub, 1) for sub in subs])
+
+    def on_disconnect(self, mqttc, obj, rc):
+        self.connected = False
+
+    def remember_echo(self, message):
+        """ Expect an echo of a message about to be mirrored. Kept
+        however long the broker takes to get it """
+        key = (message.topic, message.payload)
+        time_now = time.monotonic()
+        self.echo_lock.acquire()
+        try:
+            # Forget delivered entries whose echo never came, so the
+            # dict stays small
+            for old in [k for k, v in self.echoes.items() if v[1] == 0 and time_now - v[2] > ECHO_WINDOW]:
+                del self.echoes[old]
+            entry = self.echoes.setdefault(key, [0, 0, time_now])
+            entry[0] += 1
+            entry[1] += 1
+        finally:
+            self.echo_lock.release()
+
+    def echo_delivered(self, message):
+        """ Broker has a mirrored message, its echo is due within
+        ECHO_WINDOW from now """
+        key = (message.topic, message.payload)
+        self.echo_lock.acquire()
+        try:
+            entry = self.echoes.get(key)
+            if entry is not None:
+                entry[1] = max(0, entry[1] - 1)
+                entry[2] = time.monotonic()
+        finally:
+            self.echo_lock.release()
+
+    def forget_echo(self, message):
+        """ Message was never handed to the broker, no echo will come """
+        key = (message.topic, message.payload)
+        self.echo_lock.acquire()
+        try:
+            entry = self.echoes.get(key)
+            if entry is not None:
+                entry[0] -= 1
+                entry[1] = max(0, entry[1] - 1)
+                if entry[0] <= 0:
+                    del self.echoes[key]
+        finally:
+            self.echo_lock.release()
+
+    def is_echo(self, message):
+        key = (message.topic, message.payload)
+        self.echo_lock.acquire()
+        try:
+            entry = self.echoes.get(key)
+            if entry is None:
+                return False
+            entry[0] -= 1
+            # An echo can overtake the ack of its own publish
+            entry[1] = min(entry[1], entry[0])
+            if entry[0] <= 0:
+                del self.echoes[key]
+            return True
+        finally:
+            self.echo_lock.release()
+
+    def mirror_loop(self):
+        """ Publish local messages to the broker, in order """
+        while True:
+            message = self.outgoing.get()
+            if message is None:
+                return
+            self.remember_echo(message)
+            # paho queues QoS 1 messages itself while disconnected,
+            # QoS 0 ones are dropped
+            info = self.client.publish(
+                message.topic, message.payload, message.qos, message.retain
+            )
+            if info.rc != transport.MQTT_ERR_SUCCESS and (
+                message.qos == 0 or info.rc != transport.MQTT_ERR_NO_CONN
+            ):
+                self.forget_echo(message)
+                continue
+            self.ack_lock.acquire()
+            try:
+                acked = self.early_acks.pop(info.mid, None) is not None
+                if not acked:
+                    self.unacked[info.mid] = message
+            finally:
+                self.ack_lock.release()
+            if acked:
+                self.delivered(message)
+
+    def delivered(self, message):
+        """ Broker has a mirrored message (sent, for QoS 0) """
+        self.echo_delivered(message)
+        if message.on_mirrored is not None:
+            message.on_mirrored()
+
+    def on_publish(self, mqttc, obj, mid):
+        """ Broker acknowledged a mirrored message """
+        time_now = time.monotonic()
+        self.ack_lock.acquire()
+        try:
+            message = self.unacked.pop(mid, None)
+            if message is None:
+                # publish() has not returned yet, let mirror_loop claim
+                # it. Forget anything older than a few seconds, in case
+                # a mid is never claimed
+                for old in [m for m, t in self.early_acks.items() if time_now - t > ECHO_WINDOW]:
+                    del self.early_acks[old]
+                self.early_acks[mid] = time_now
+        finally:
+            self.ack_lock.release()
+        if message is not None:
+            self.delivered(message)
+
+    def on_message(self, mqttc, obj, message):
+        """ Message from the broker, pass on unless we sent it """
+        if self.is_echo(message):
+            return
+        if any(transport.topic_matches(t, message.topic) for t in EXPIRING_TOPICS):
+            name, fields = events.decode(message.payload)
+            if events.expired(fields, EVENT_TTL):
+                age = events.age(fields)
+                self.expired.drop(name, age)
+                self.log.info("Dropped {} {:.1f}s old from broker, {}",
+                    name, age, self.expired.format_summary())
+                return
+        self.dispatch(Message(
+            message.topic, message.payload, message.qos, message.retain
+        ))
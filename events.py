@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import time
+
+# Doorbell event names sent on event/doorbell
+EVENT_DING = "DING"
+EVENT_DONG = "DONG"
+# Seconds after which a stamped event is too old to act on, e.g. a
+# backlog delivered when a ringer reconnects. 0 never expires
+EVENT_TTL = 30.0
+
+
+def encode(name, **fields):
+    """ Build an event payload, e.g. "DING ts=1700000000.123".
+    The event name is always the first word so plain "DING"
+    payloads from older clients still decode """
+    parts = [name]
+    for key in sorted(fields):
+        value = fields[key]
+        if value is None:
+            continue
+        if isinstance(value, float):
+            value = "{:.6f}".format(value)
+        parts.append("{}={}".format(key, value))
+    return " ".join(parts)
+
+
+def decode(payload):
+    """ Split an event payload into its name and a dict of fields """
+    if isinstance(payload, bytes):
+        payload = payload.decode("utf-8", "replace")
+    parts = payload.split()
+    if len(parts) == 0:
+        return "", {}
+    fields = {}
+    for part in parts[1:]:
+        key, sep, value = part.partition("=")
+        if sep:
+            fields[key] = value
+    return parts[0], fields
+
+
+def field_float(fields, key, default=None):
+    """ Read a numeric field, ignoring anything malformed """
+    try:
+        return float(fields[key])
+    except (KeyError, ValueError):
+        return default
+
+
+def stamp(name, wall=None, **fields):
+    """ Encode an event stamped with the wall clock time at origin """
+    if wall is None:
+        wall = time.time()
+    return encode(name, ts=wall, **fields)
+
+
+def age(fields, now=None):
+    """ Seconds since an event was stamped at origin, None if unstamped """
+    sent = field_float(fields, "ts")
+    if sent is None:
+        return None
+    if now is None:
+        now = time.time()
+    return now - sent
+
+
+def expired(fields, ttl=EVENT_TTL, now=None):
+    """ Is a stamped event older than ttl seconds. Unstamped events,
+    e.g. from dashboard apps, never expire """
+    if not ttl or ttl <= 0:
+        return False
+    event_age = age(fields, now)
+    return event_age is not None and event_age > ttl
+
+
+def ping_reply(client_id, ping_fields, wall=None):
+    """ Reply to a PING. Plain PINGs get the plain client ID, as
+    always. Timed PINGs (seq/from/t0) are echoed back along with our
+    own clock reading t1, so the sender can measure round trip time
+    and clock offset """
+    if "t0" not in ping_fields and "seq" not in ping_fields:
+        return client_id
+    if wall is None:
+        wall = time.time()
+    return encode(
+        client_id,
+        seq=ping_fields.get("seq"),
+        to=ping_fields.get("from"),
+        t0=ping_fields.get("t0"),
+        t1=wall
+    )
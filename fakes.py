@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+import sys
+import time
+import types
+import threading
+
+
+# Stand in for RPi.GPIO. Pin levels are set by the caller and edges are
+# passed to the registered callbacks, like the GPIO library's own
+# callback thread would.
+class FakeGPIO():
+
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    PUD_UP = 22
+    PUD_DOWN = 21
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self):
+        # Constructor
+        self.levels = {}
+        # Pin mapped to (edge, callback)
+        self.callbacks = {}
+        # Edges passed to callbacks so far
+        self.edges = 0
+        self.lock = threading.Lock()
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        level = self.LOW
+        if pull_up_down == self.PUD_UP:
+            level = self.HIGH
+        self.levels[pin] = level
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def input(self, pin):
+        return self.levels.get(pin, self.LOW)
+
+    def output(self, pin, level):
+        self.levels[pin] = level
+
+    def cleanup(self, pin=None):
+        self.callbacks.clear()
+
+    def set_level(self, pin, level):
+        """ Drive a pin, calling its callback if the edge is watched """
+        # One edge at a time, like the single GPIO callback thread
+        self.lock.acquire()
+        try:
+            previous = self.levels.get(pin, self.LOW)
+            self.levels[pin] = level
+            if previous == level:
+                return
+            edge, callback = self.callbacks.get(pin, (None, None))
+            if callback is None:
+                return
+            if (
+                edge == self.BOTH
+                or (edge == self.RISING and level == self.HIGH)
+                or (edge == self.FALLING and level == self.LOW)
+            ):
+                self.edges += 1
+                callback(pin)
+        finally:
+            self.lock.release()
+
+    def press(self, pin, held=0.0, bounces=0, bounce_gap=0.001):
+        """ Press and release a button, with contact bounce at each end """
+        for n in range(bounces):
+            self.set_level(pin, self.HIGH)
+            time.sleep(bounce_gap)
+            self.set_level(pin, self.LOW)
+            time.sleep(bounce_gap)
+        self.set_level(pin, self.HIGH)
+        time.sleep(held)
+        for n in range(bounces):
+            self.set_level(pin, self.LOW)
+            time.sleep(bounce_gap)
+            self.set_level(pin, self.HIGH)
+            time.sleep(bounce_gap)
+        self.set_level(pin, self.LOW)
+
+
+# Stand in for pixelpi.Strip, keeping the LED colours in memory.
+# With realtime set, showLEDs takes as long as sending the strip's
+# data down the wire would (30us per WS2812 LED).
+class FakeStrip():
+
+    def __init__(self, terminal=1, size=1, shape="straight", ledtype="WS2812",
+                 brightness=255, realtime=False):
+        # Constructor
+        self.terminal = terminal
+        self.size = size
+        self.shape = shape
+        self.ledtype = ledtype
+        self.brightness = brightness
+        self.realtime = realtime
+        self.leds = [(0, 0, 0)] * size
+        # Colours last sent to the strip
+        self.shown = list(self.leds)
+        self.shows = 0
+
+    def getLEDs(self):
+        return list(self.leds)
+
+    def setLEDs(self, rgb=(0, 0, 0), led=None):
+        if led is None:
+            self.leds = [rgb] * self.size
+        elif 0 <= led < self.size:
+            self.leds[led] = rgb
+
+    def showLEDs(self):
+        if self.realtime:
+            time.sleep(self.size * 0.00003)
+        self.shown = list(self.leds)
+        self.shows += 1
+
+    def clearLEDs(self):
+        self.setLEDs((0, 0, 0))
+
+    def lit(self):
+        """ Number of LEDs showing any colour """
+        return len([rgb for rgb in self.shown if rgb != (0, 0, 0)])
+
+
+def install(gpio=None, strip_class=FakeStrip):
+    """ Put the fakes in place of RPi.GPIO and pixelpi, before the
+    daemons are imported. Returns the FakeGPIO """
+    if gpio is None:
+        gpio = FakeGPIO()
+    rpi = types.ModuleType("RPi")
+    rpi.GPIO = gpio
+    sys.modules["RPi"] = rpi
+    sys.modules["RPi.GPIO"] = gpio
+    pixelpi = types.ModuleType("pixelpi")
+    pixelpi.Strip = strip_class
+    sys.modules["pixelpi"] = pixelpi
+    return gpio
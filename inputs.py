@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+import os
+import re
+import json
+import debounce
+import outbox
+
+# Input and tune names, short and plain ASCII so DING/DONG payloads
+# carrying both always fit an outbox record
+NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,16}$")
+# Settings of an input that its config does not give
+INPUT_DEFAULTS = {
+    "name": "front",
+    "pin": 23,
+    # Topic its DING/DONGs are published on
+    "topic": "event/doorbell",
+    # Tune set ringers play for it, None for their selected set
+    "tune": None,
+    # Debounce settings, seconds
+    "settle": 0.05,
+    "min_hold": 0.02,
+    "repeat_gap": 1.0,
+    "stuck_limit": 10.0,
+}
+
+
+# One doorbell button (or any other contact) wired to a GPIO pin,
+# with its own debounce state and the details of its current press.
+class ButtonInput():
+
+    def __init__(self, config):
+        # Constructor
+        settings = dict(INPUT_DEFAULTS)
+        settings.update(config)
+        self.name = str(settings["name"])
+        self.pin = int(settings["pin"])
+        self.topic = settings["topic"]
+        self.tune = settings["tune"]
+        for name in (self.name, self.tune):
+            if name is not None and not NAME_PATTERN.match(name):
+                raise ValueError("Input and tune names must be 1-16 of A-Z a-z 0-9 _ -, not " + repr(name))
+        if len(self.topic.encode("utf-8")) > outbox.TOPIC_SIZE:
+            raise ValueError("Input topic over {} bytes: {}".format(outbox.TOPIC_SIZE, self.topic))
+        # Debounce state machine, runs on the monotonic clock
+        self.debouncer = debounce.Debouncer(
+            settle_time=settings["settle"],
+            min_hold=settings["min_hold"],
+            repeat_gap=settings["repeat_gap"],
+            stuck_limit=settings["stuck_limit"]
+        )
+        # Set when a press was over the limit, so its release is too
+        self.ring_suppressed = False
+        # Details of the current press, logged once released
+        self.press_wall = None
+        self.press_edge = None
+        self.press_latency = -1.0
+
+    def __repr__(self):
+        return "{}(pin {})".format(self.name, self.pin)
+
+
+def load_inputs(filename, default):
+    """ Inputs from a JSON list of configs in filename, or from
+    default if there is no such file """
+    configs = default
+    if filename and os.path.isfile(filename):
+        with open(filename) as f:
+            configs = json.load(f)
+    if len(configs) == 0:
+        raise ValueError("No doorbell inputs configured")
+    inputs = [ButtonInput(config) for config in configs]
+    names = set(item.name for item in inputs)
+    pins = set(item.pin for item in inputs)
+    if len(names) != len(inputs) or len(pins) != len(inputs):
+        raise ValueError("Input names and pins must be unique")
+    return inputs
@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 import math
-import time
 import threading
 from random import randint
+import clocks
 
 
 class LedStrip():
 
-    def __init__(self, pixelpi_strip, allow_seasonal_display=None, led_mode=1):
+    def __init__(self, pixelpi_strip, allow_seasonal_display=None, led_mode=1, clock=None):
         # Constructor
         self.pixelpi_strip = pixelpi_strip
+        # Source of time and sleeps, a virtual clock speeds up simulations
+        self.clock = clock
+        if self.clock is None:
+            self.clock = clocks.SYSTEM_CLOCK
         # LED On flag
         self.led_on = False
         # LED ON Colour
@@ -164,7 +168,7 @@ class LedStrip():
             red += red_int
             green += green_int
             blue += blue_int
-            time.sleep(interval)
+            self.clock.sleep(interval)
 
         # Finally, ensure we reach the final colour
         self.set_all(toR, toG, toB)
@@ -203,6 +207,12 @@ class LedStrip():
             # Set flag
             self.set_on(True)
 
+    def blank(self):
+        """ Turn every LED off in a single update, no fade. For strips
+        that should already be dark but may have been left lit """
+        self.set_all(0, 0, 0)
+        self.set_on(False)
+
     def switch_off(self, force=False):
         """ Switch the lights off (if not already off) """
         if self.is_on() or force:
@@ -367,7 +377,7 @@ class LedStrip():
             finally:
                 self.lock.release()
             # Sleep a small while between each LED setting
-            time.sleep(0.05)
+            self.clock.sleep(0.05)
             # Increment loop index
             if forwards:
                 x = x+1
@@ -376,7 +386,7 @@ class LedStrip():
 
     def millis(self):
         """ Return the current time in milliseconds  """
-        return int(round(time.time() * 1000))
+        return int(round(self.clock.time() * 1000))
 
     def party_mode(self):
         """ Bouncing Balls """
@@ -447,12 +457,12 @@ class LedStrip():
             self.effect_set_even_odd(255, 0, 0, even=True)
             self.effect_set_even_odd(0, 255, 0, even=False)
             # Pause for a small time
-            time.sleep(0.5)
+            self.clock.sleep(0.5)
 
             self.effect_set_even_odd(0, 255, 0, even=True)
             self.effect_set_even_odd(255, 0, 0, even=False)
             # Pause for a small time
-            time.sleep(0.5)
+            self.clock.sleep(0.5)
 
     def christmas_display_2(self):
         try:
@@ -472,7 +482,7 @@ class LedStrip():
                     forwards=forwards
                 )
                 # Sleep a small while between each LED setting
-                time.sleep(0.05)
+                self.clock.sleep(0.05)
                 # Swipe the LEDs off
                 self.effect_swipe(
                     red=0,
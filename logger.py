@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import sys
+import time
+import queue
+import threading
+from collections import OrderedDict
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+# Messages below this level are dropped before any formatting
+LOG_LEVEL = INFO
+# Max lines per message format in each RATE_INTERVAL seconds
+RATE_LIMIT = 10
+RATE_INTERVAL = 10.0
+# Message formats whose rates are tracked by each logger, the least
+# recently used is forgotten beyond this
+RATE_FORMATS = 256
+# Lines waiting for the writer thread, more than this are dropped
+QUEUE_SIZE = 1000
+
+
+# Writes log lines from a single background thread, so callers on the
+# ring path never block on stdout. Shared by every Logger in the process.
+class LogWriter():
+
+    def __init__(self, stream=None):
+        # Constructor
+        self.stream = stream
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        # Lines lost because the queue was full
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, line):
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            line = self.queue.get()
+            stream = self.stream
+            if stream is None:
+                stream = sys.stdout
+            try:
+                stream.write(line + "\n")
+                if self.queue.empty():
+                    stream.flush()
+            except (OSError, ValueError):
+                # Nowhere to write to, e.g. stdout closed under cron
+                pass
+
+    def flush(self, timeout=1.0):
+        """ Wait (briefly) for queued lines to be written """
+        deadline = time.monotonic() + timeout
+        while not self.queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def writer():
+    """ The process wide writer, started on first use """
+    global _writer
+    _writer_lock.acquire()
+    try:
+        if _writer is None:
+            _writer = LogWriter()
+        return _writer
+    finally:
+        _writer_lock.release()
+
+
+def set_level(level):
+    """ Change the level for every Logger """
+    global LOG_LEVEL
+    LOG_LEVEL = level
+
+
+class Logger():
+
+    def __init__(self, name):
+        # Constructor
+        self.name = name
+        # Per message format: [window start, lines in window, suppressed],
+        # least recently used first
+        self.rates = OrderedDict()
+        self.lock = threading.Lock()
+
+    def enabled(self, level):
+        return level >= LOG_LEVEL
+
+    def log(self, level, message, *args):
+        """ Queue a line. Formatting with args only happens if it is
+        going to be written """
+        if level < LOG_LEVEL:
+            return
+        time_now = time.monotonic()
+        suppressed = 0
+        self.lock.acquire()
+        try:
+            rate = self.rates.get(message)
+            if rate is None or time_now - rate[0] >= RATE_INTERVAL:
+                if rate is not None:
+                    suppressed = rate[2]
+                rate = [time_now, 0, 0]
+                self.rates[message] = rate
+                if len(self.rates) > RATE_FORMATS:
+                    self.rates.popitem(last=False)
+            self.rates.move_to_end(message)
+            if rate[1] >= RATE_LIMIT:
+                rate[2] += 1
+                return
+            rate[1] += 1
+        finally:
+            self.lock.release()
+        if args:
+            try:
+                message = message.format(*args)
+            except (IndexError, KeyError, ValueError):
+                message = message + " " + " ".join(str(a) for a in args)
+        line = "{} {} {}: {}".format(
+            time.strftime("%Y-%m-%d %H:%M:%S"), LEVEL_NAMES.get(level, level),
+            self.name, message
+        )
+        if suppressed > 0:
+            line += " ({} similar suppressed)".format(suppressed)
+        writer().put(line)
+
+    def debug(self, message, *args):
+        self.log(DEBUG, message, *args)
+
+    def info(self, message, *args):
+        self.log(INFO, message, *args)
+
+    def warning(self, message, *args):
+        self.log(WARNING, message, *args)
+
+    def error(self, message, *args):
+        self.log(ERROR, message, *args)
+
+
+_loggers = {}
+
+
+def get_logger(name):
+    """ One Logger per name """
+    _writer_lock.acquire()
+    try:
+        if name not in _loggers:
+            _loggers[name] = Logger(name)
+        return _loggers[name]
+    finally:
+        _writer_lock.release()
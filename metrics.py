@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+import os
+import time
+import threading
+from collections import deque
+
+
+class LatencyRecorder():
+
+    def __init__(self, name, window=200):
+        # Constructor
+        self.name = name
+        # Only the most recent samples are kept, so memory stays fixed
+        self.samples = deque(maxlen=window)
+        # Total number of samples ever recorded
+        self.count = 0
+        # Thread lock
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        """ Store a single latency sample (in seconds) """
+        self.lock.acquire()
+        try:
+            self.samples.append(seconds)
+            self.count += 1
+        finally:
+            self.lock.release()
+
+    def percentile(self, percent, ordered=None):
+        """ Return the given percentile of the current window (seconds) """
+        if ordered is None:
+            self.lock.acquire()
+            try:
+                ordered = sorted(self.samples)
+            finally:
+                self.lock.release()
+        if len(ordered) == 0:
+            return None
+        # Nearest rank percentile
+        index = int(round((percent / 100.0) * (len(ordered) - 1)))
+        return ordered[index]
+
+    def summary(self):
+        """ Return a dict of count and percentiles in milliseconds """
+        self.lock.acquire()
+        try:
+            ordered = sorted(self.samples)
+            count = self.count
+        finally:
+            self.lock.release()
+
+        result = {"name": self.name, "count": count}
+        for percent in (50, 90, 99):
+            value = self.percentile(percent, ordered)
+            if value is not None:
+                value = round(value * 1000.0, 3)
+            result["p" + str(percent)] = value
+        if len(ordered) > 0:
+            result["max"] = round(ordered[-1] * 1000.0, 3)
+        else:
+            result["max"] = None
+        return result
+
+    def format_summary(self):
+        """ Return a single human readable summary line """
+        s = self.summary()
+        return "{}: n={} p50={}ms p90={}ms p99={}ms max={}ms".format(
+            s["name"], s["count"], s["p50"], s["p90"], s["p99"], s["max"]
+        )
+
+
+class DropCounter():
+
+    def __init__(self, name):
+        # Constructor
+        self.name = name
+        # Drops by reason, e.g. event name
+        self.counts = {}
+        self.total = 0
+        # Age in seconds of the oldest event dropped
+        self.oldest = None
+        # Thread lock
+        self.lock = threading.Lock()
+
+    def drop(self, reason, age=None):
+        """ Count a dropped event """
+        self.lock.acquire()
+        try:
+            self.counts[reason] = self.counts.get(reason, 0) + 1
+            self.total += 1
+            if age is not None and (self.oldest is None or age > self.oldest):
+                self.oldest = age
+        finally:
+            self.lock.release()
+
+    def summary(self):
+        """ Return a dict of the total, oldest age and counts by reason """
+        self.lock.acquire()
+        try:
+            result = {"name": self.name, "total": self.total, "oldest": self.oldest}
+            result["counts"] = dict(self.counts)
+        finally:
+            self.lock.release()
+        return result
+
+    def format_summary(self):
+        """ Return a single human readable summary line """
+        s = self.summary()
+        parts = ["total={}".format(s["total"])]
+        parts += ["{}={}".format(k, v) for k, v in sorted(s["counts"].items())]
+        if s["oldest"] is not None:
+            parts.append("oldest={:.1f}s".format(s["oldest"]))
+        return "{}: {}".format(s["name"], " ".join(parts))
+
+
+def process_age():
+    """ Seconds since this process started, None if unknown (not Linux) """
+    try:
+        with open("/proc/self/stat") as f:
+            # Fields after the command name, which may hold spaces
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        # Field 22, start time in clock ticks after boot
+        return uptime - int(fields[19]) / float(os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# Time from process start to each stage of a daemon starting up, e.g.
+# sounds decoded or broker connected, so slow starts can be found.
+class StartupTimer():
+
+    def __init__(self, name):
+        # Constructor
+        self.name = name
+        # Monotonic time the process started, so imports are counted.
+        # Falls back to now if it is not known
+        age = process_age()
+        self.start = time.monotonic()
+        if age is not None and age >= 0:
+            self.start -= age
+        # Seconds from process start to each stage, in order reached
+        self.stages = []
+        self.reported = False
+        # Thread lock
+        self.lock = threading.Lock()
+
+    def mark(self, stage):
+        """ Note a stage has been reached. Only the first time counts.
+        Returns seconds since process start """
+        seconds = time.monotonic() - self.start
+        self.lock.acquire()
+        try:
+            for name, reached in self.stages:
+                if name == stage:
+                    return reached
+            self.stages.append((stage, seconds))
+        finally:
+            self.lock.release()
+        return seconds
+
+    def complete(self, stages):
+        """ True just once, when all of these stages have been reached """
+        self.lock.acquire()
+        try:
+            reached = set(name for name, seconds in self.stages)
+            if self.reported or not set(stages) <= reached:
+                return False
+            self.reported = True
+            return True
+        finally:
+            self.lock.release()
+
+    def format_summary(self):
+        """ Return a single human readable summary line """
+        self.lock.acquire()
+        try:
+            stages = list(self.stages)
+        finally:
+            self.lock.release()
+        return "{}: {}".format(self.name, " ".join(
+            "{}={:.3f}s".format(name, seconds) for name, seconds in stages
+        ))
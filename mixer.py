@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+import threading
+import numpy as np
+
+# Length of the fade applied to a voice that is cut short
+FADE_TIME = 0.02  # seconds
+# Above this level the output is gently compressed rather than clipped
+SOFT_CLIP_THRESHOLD = 0.8
+# Full scale for 16 bit samples
+FULL_SCALE = 32767.0
+
+
+def to_float(pcm, channels):
+    """ 16 bit PCM bytes to a (frames, channels) float32 array, -1.0 to 1.0 """
+    samples = np.frombuffer(pcm, dtype=np.int16).reshape(-1, channels)
+    return samples.astype(np.float32) / FULL_SCALE
+
+
+def to_int32(pcm, width):
+    """ PCM bytes of 1 to 4 byte samples to full scale int32 samples.
+    8 bit samples are unsigned, as in WAV files """
+    data = np.frombuffer(pcm, dtype=np.uint8)
+    if width == 1:
+        return (data.astype(np.int32) - 128) << 24
+    if width == 2:
+        return np.frombuffer(pcm, dtype="<i2").astype(np.int32) << 16
+    if width == 3:
+        data = data[:len(data) - len(data) % 3].reshape(-1, 3).astype(np.int32)
+        return (data[:, 0] << 8) | (data[:, 1] << 16) | (data[:, 2] << 24)
+    if width == 4:
+        return np.frombuffer(pcm, dtype="<i4").astype(np.int32)
+    raise ValueError("Unsupported sample width: {}".format(width))
+
+
+def from_int32(samples, width):
+    """ Full scale int32 samples to PCM bytes of 1 to 4 byte samples """
+    if width == 1:
+        return ((samples >> 24) + 128).astype(np.uint8).tobytes()
+    if width == 2:
+        return (samples >> 16).astype("<i2").tobytes()
+    if width == 3:
+        data = np.empty((len(samples), 3), dtype=np.uint8)
+        for n in range(3):
+            data[:, n] = (samples >> (8 * (n + 1))) & 0xff
+        return data.tobytes()
+    if width == 4:
+        return samples.astype("<i4").tobytes()
+    raise ValueError("Unsupported sample width: {}".format(width))
+
+
+def convert(pcm, width, channels, rate, to_width, to_channels, to_rate):
+    """ Convert PCM bytes to another sample width, mono or stereo,
+    and sample rate (linear interpolation) """
+    samples = to_int32(pcm, width)
+    samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels)
+    if channels == 1 and to_channels == 2:
+        samples = np.repeat(samples, 2, axis=1)
+    elif channels == 2 and to_channels == 1:
+        samples = ((samples[:, 0].astype(np.int64) + samples[:, 1]) // 2).astype(np.int32).reshape(-1, 1)
+    if rate != to_rate and len(samples) > 0:
+        frames = int(len(samples) * float(to_rate) / rate)
+        times = np.arange(frames) * (float(rate) / to_rate)
+        source = np.arange(len(samples))
+        samples = np.stack([
+            np.round(np.interp(times, source, samples[:, n])).astype(np.int64)
+            for n in range(samples.shape[1])
+        ], axis=1).clip(-2 ** 31, 2 ** 31 - 1).astype(np.int32)
+    return from_int32(samples.reshape(-1), to_width)
+
+
+class Voice():
+
+    def __init__(self, name, samples, delay_frames=0, on_start=None):
+        # A single sound playing
+        self.name = name
+        self.samples = samples
+        # Called once the first block with this voice in it is written
+        self.on_start = on_start
+        # Negative while waiting to start
+        self.position = -delay_frames
+        # Frames into the fade out, None when not fading
+        self.fade_position = None
+
+    def remaining(self):
+        return len(self.samples) - max(0, self.position)
+
+
+# Sums overlapping voices into fixed size blocks. All buffers are
+# allocated up front, so a burst of rings costs the same CPU per block
+# and no extra memory however many arrive.
+class Mixer():
+
+    def __init__(self, rate, channels, block_frames, limit_number=4):
+        # Constructor
+        self.rate = rate
+        self.channels = channels
+        self.block_frames = block_frames
+        # Max voices sounding at once, not counting ones fading out
+        self.limit_number = limit_number
+        self.voices = []
+        # Voices stolen so far
+        self.stolen = 0
+        # on_start callbacks of voices heard for the first time
+        self.started = []
+        # Fade out ramp from 1.0 down to 0.0
+        fade_frames = max(1, int(rate * FADE_TIME))
+        self.fade = np.linspace(1.0, 0.0, fade_frames, dtype=np.float32)
+        # Preallocated work buffers
+        self.mix = np.zeros((block_frames, channels), dtype=np.float32)
+        self.scratch = np.zeros((block_frames, channels), dtype=np.float32)
+        self.magnitude = np.zeros((block_frames, channels), dtype=np.float32)
+        self.output = np.zeros((block_frames, channels), dtype=np.int16)
+        # Thread lock
+        self.lock = threading.Lock()
+
+    def add(self, name, samples, delay_frames=0, on_start=None):
+        """ Start a voice, stealing the oldest if over the limit.
+        A delay starts the voice that many frames into the next block(s) """
+        self.lock.acquire()
+        try:
+            active = [v for v in self.voices if v.fade_position is None]
+            while len(active) >= self.limit_number:
+                # Fade the oldest out rather than cut it dead (no click)
+                oldest = active.pop(0)
+                oldest.fade_position = 0
+                self.stolen += 1
+            # A flood of rings can not pile up fading voices either
+            while len(self.voices) >= 2 * self.limit_number:
+                self.voices.pop(0)
+            self.voices.append(Voice(name, samples, delay_frames, on_start))
+        finally:
+            self.lock.release()
+
+    def take_started(self):
+        """ on_start callbacks due since the last call """
+        self.lock.acquire()
+        try:
+            started = self.started
+            self.started = []
+        finally:
+            self.lock.release()
+        return started
+
+    def active(self):
+        """ Number of voices still producing sound """
+        return len(self.voices)
+
+    def _soft_clip(self, block):
+        """ Linear below the threshold, smoothly approaching full scale above """
+        t = SOFT_CLIP_THRESHOLD
+        np.abs(block, out=self.magnitude)
+        over = self.magnitude > t
+        if not over.any():
+            return
+        knee = t + (1.0 - t) * np.tanh((self.magnitude[over] - t) / (1.0 - t))
+        block[over] = np.copysign(knee, block[over])
+
+    def next_block(self):
+        """ Mix one block, returns 16 bit PCM bytes (or None if idle) """
+        self.lock.acquire()
+        try:
+            if len(self.voices) == 0:
+                return None
+            mix = self.mix
+            mix.fill(0.0)
+            finished = []
+            for voice in self.voices:
+                # Frames of silence before a delayed voice starts
+                start = 0
+                if voice.position < 0:
+                    start = min(self.block_frames, -voice.position)
+                    voice.position += start
+                    if voice.fade_position is not None:
+                        # Stolen before it was heard
+                        finished.append(voice)
+                        continue
+                frames = min(self.block_frames - start, voice.remaining())
+                if voice.on_start is not None and frames > 0:
+                    self.started.append(voice.on_start)
+                    voice.on_start = None
+                segment = voice.samples[voice.position:voice.position + frames]
+                end = start + frames
+                if voice.fade_position is not None:
+                    # Apply what is left of the fade
+                    fade_left = len(self.fade) - voice.fade_position
+                    frames = min(frames, fade_left)
+                    end = start + frames
+                    ramp = self.fade[voice.fade_position:voice.fade_position + frames]
+                    np.multiply(segment[:frames], ramp[:, None], out=self.scratch[start:end])
+                    mix[start:end] += self.scratch[start:end]
+                    voice.fade_position += frames
+                    if voice.fade_position >= len(self.fade):
+                        finished.append(voice)
+                else:
+                    mix[start:end] += segment
+                voice.position += frames
+                if voice.remaining() <= 0:
+                    finished.append(voice)
+            if len(finished) > 0:
+                self.voices = [v for v in self.voices if v not in finished]
+        finally:
+            self.lock.release()
+
+        self._soft_clip(mix)
+        np.multiply(mix, FULL_SCALE, out=self.scratch)
+        np.copyto(self.output, self.scratch, casting="unsafe")
+        return self.output.tobytes()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import json
+import time
+import threading
+import transport
+import events
+import metrics
+
+MQTT_CLIENT_ID = "fleet_monitor"
+MQTT_SUB_TOPIC = [("connection/reply", 1)]
+MQTT_PUB_TOPIC = [("connection/ping", 1), ("status/fleet", 1)]
+# Devices expected to answer, any others that reply are added as seen
+DEVICES = ["doorbell_button", "front_door_ringer", "front_door_lights"]
+# Seconds between pings
+PING_INTERVAL = 60.0
+# Seconds to wait for replies before counting a device as missed
+REPLY_TIMEOUT = 5.0
+# Round trips kept per device for the percentiles
+RTT_WINDOW = 100
+
+
+class Device():
+
+    def __init__(self, name):
+        # Health of a single device
+        self.name = name
+        self.rtt = metrics.LatencyRecorder(name, window=RTT_WINDOW)
+        self.replies = 0
+        self.missed = 0
+        # Missed in a row, reset by any reply
+        self.missed_run = 0
+        self.last_seen = None
+
+    def summary(self):
+        rtt = self.rtt.summary()
+        return {
+            "replies": self.replies,
+            "missed": self.missed,
+            "missed_run": self.missed_run,
+            "last_seen": self.last_seen,
+            "rtt_p50_ms": rtt["p50"],
+            "rtt_p90_ms": rtt["p90"],
+            "rtt_p99_ms": rtt["p99"],
+            "rtt_max_ms": rtt["max"],
+            "alive": self.missed_run == 0 and self.last_seen is not None
+        }
+
+
+class FleetMonitor():
+
+    def __init__(self, client=None):
+        """ Initialise member variables.
+        Pass an eventbus client to run in co-located mode """
+        self.devices = {}
+        for name in DEVICES:
+            self.devices[name] = Device(name)
+        # Current ping
+        self.seq = 0
+        self.ping_sent = None
+        # Devices that have answered the current ping
+        self.answered = set()
+        self.killed = False
+        # Thread lock
+        self.lock = threading.Lock()
+
+        # MQTT Initialisation
+        self.transport = transport.Transport(MQTT_CLIENT_ID, client)
+        self.log = self.transport.log
+        self.transport.subscribe(MQTT_SUB_TOPIC[0][0], self.on_reply)
+        self.transport.start()
+
+    def on_reply(self, topic, message, raw):
+        """ connection/reply received """
+        self.handle_reply(message, time.monotonic())
+
+    def handle_reply(self, payload, time_now):
+        """ Match a connection/reply to our current ping """
+        name, fields = events.decode(payload)
+        if name == "":
+            return
+        timed = "to" in fields or "seq" in fields
+        if timed:
+            # Timed reply, must be to our ping and the current one
+            if fields.get("to") != MQTT_CLIENT_ID:
+                return
+            try:
+                seq = int(fields.get("seq", ""))
+            except ValueError:
+                return
+        else:
+            # Older device answering with just its ID. It may be
+            # answering someone else's ping, so it only shows the
+            # device is alive and is kept out of the round trips
+            seq = self.seq
+        self.lock.acquire()
+        try:
+            if seq != self.seq or self.ping_sent is None:
+                # Late reply to an earlier ping, already counted as missed
+                return
+            if time_now - self.ping_sent > REPLY_TIMEOUT or name in self.answered:
+                return
+            self.answered.add(name)
+            device = self.devices.get(name)
+            if device is None:
+                device = Device(name)
+                self.devices[name] = device
+            if timed:
+                device.rtt.record(time_now - self.ping_sent)
+            device.replies += 1
+            device.missed_run = 0
+            device.last_seen = time.time()
+        finally:
+            self.lock.release()
+
+    def ping(self):
+        """ Start a new round of pings """
+        self.lock.acquire()
+        try:
+            self.seq += 1
+            self.answered = set()
+            self.ping_sent = time.monotonic()
+            seq = self.seq
+        finally:
+            self.lock.release()
+        self.transport.publish(
+            MQTT_PUB_TOPIC[0][0],
+            events.encode("PING", seq=seq, t0=time.time(), **{"from": MQTT_CLIENT_ID})
+        )
+
+    def close_round(self):
+        """ Count anyone who did not answer in time """
+        self.lock.acquire()
+        try:
+            for name, device in self.devices.items():
+                if name not in self.answered:
+                    device.missed += 1
+                    device.missed_run += 1
+            self.ping_sent = None
+        finally:
+            self.lock.release()
+
+    def summary(self):
+        self.lock.acquire()
+        try:
+            devices = {}
+            for name, device in self.devices.items():
+                devices[name] = device.summary()
+        finally:
+            self.lock.release()
+        return {"time": time.time(), "seq": self.seq, "devices": devices}
+
+    def publish_summary(self):
+        """ Retained, so a dashboard sees the latest as soon as it connects """
+        summary = self.summary()
+        self.transport.publish(MQTT_PUB_TOPIC[1][0], json.dumps(summary), retain=True)
+        for name, device in summary["devices"].items():
+            if not device["alive"]:
+                self.log.warning("{} not answering ({} missed)", name, device["missed_run"])
+
+    def run(self):
+        while True:
+            # Check exit flag on each loop
+            if self.killed:
+                return
+            time_start = time.monotonic()
+            self.ping()
+            time.sleep(REPLY_TIMEOUT)
+            self.close_round()
+            self.publish_summary()
+            # Keep to the schedule however long the round took
+            time.sleep(max(0, PING_INTERVAL - (time.monotonic() - time_start)))
+
+
+if __name__ == "__main__":
+    monitor = FleetMonitor()
+    try:
+        monitor.run()
+    except:
+        pass
+    finally:
+        monitor.transport.stop()
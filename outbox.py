@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+import os
+import struct
+import threading
+from collections import namedtuple
+import logger
+
+# File header: magic, capacity, next seq to write, oldest unacked seq
+HEADER = struct.Struct("<4sIQQ")
+HEADER_MAGIC = b"DBQ2"
+# Most bytes of topic and payload (UTF-8) a record holds
+TOPIC_SIZE = 64
+PAYLOAD_SIZE = 128
+# Record: seq, monotonic time, wall time, topic, payload
+RECORD = struct.Struct("<Qdd{}s{}s".format(TOPIC_SIZE, PAYLOAD_SIZE))
+
+Record = namedtuple("Record", ["seq", "mono", "wall", "topic", "payload"])
+
+
+# Fixed size disk backed ring buffer of outbound MQTT messages.
+# Messages stay on disk until the broker has acknowledged them,
+# so presses survive a broker outage or a process restart.
+class Outbox():
+
+    def __init__(self, filename, capacity=256, sync=True):
+        # Constructor
+        self.filename = filename
+        self.capacity = capacity
+        # fsync every write, on our own thread so a press is published
+        # without waiting for the SD card
+        self.sync = sync
+        self.dirty = threading.Event()
+        self.closed = False
+        # Sequence numbers, tail <= seq < head are still to be delivered
+        self.head = 0
+        self.tail = 0
+        # Handed to the MQTT client but not yet acknowledged. Only
+        # kept in memory, so after a restart they are sent again
+        self.sent = set()
+        # Acknowledged out of order, waiting for the tail to catch up
+        self.acked = set()
+        # Messages overwritten because the buffer was full
+        self.dropped = 0
+        # Thread lock
+        self.lock = threading.Lock()
+        self.file = self._open()
+        self.sync_thread = None
+        if self.sync:
+            self.sync_thread = threading.Thread(target=self.sync_loop)
+            self.sync_thread.daemon = True
+            self.sync_thread.start()
+
+    def _open(self):
+        """ Open (or create) the queue file and read its header """
+        size = HEADER.size + self.capacity * RECORD.size
+        if os.path.isfile(self.filename):
+            f = open(self.filename, "r+b")
+            magic, capacity, head, tail = HEADER.unpack(f.read(HEADER.size))
+            if magic == HEADER_MAGIC and capacity == self.capacity:
+                self.head = head
+                self.tail = tail
+                return f
+            # Unknown layout, start again
+            logger.get_logger("outbox").warning("Resetting {}", self.filename)
+            f.close()
+        f = open(self.filename, "w+b")
+        f.truncate(size)
+        self.file = f
+        self._write_header()
+        return f
+
+    def _write_header(self):
+        self.file.seek(0)
+        self.file.write(
+            HEADER.pack(HEADER_MAGIC, self.capacity, self.head, self.tail)
+        )
+
+    def _flush(self):
+        self.file.flush()
+        self.dirty.set()
+
+    def sync_loop(self):
+        """ fsync the file whenever it has been written, until closed """
+        while True:
+            self.dirty.wait()
+            self.dirty.clear()
+            os.fsync(self.file.fileno())
+            if self.closed:
+                return
+
+    def _slot(self, seq):
+        return HEADER.size + (seq % self.capacity) * RECORD.size
+
+    def _read(self, seq):
+        self.file.seek(self._slot(seq))
+        rseq, mono, wall, topic, payload = RECORD.unpack(
+            self.file.read(RECORD.size)
+        )
+        return Record(
+            rseq, mono, wall,
+            topic.rstrip(b"\0").decode("utf-8", "replace"),
+            payload.rstrip(b"\0").decode("utf-8", "replace")
+        )
+
+    def append(self, topic, payload, mono, wall):
+        """ Queue a message, returns its sequence number.
+        Raises ValueError if it does not fit a record """
+        topic = topic.encode("utf-8")
+        payload = payload.encode("utf-8")
+        if len(topic) > TOPIC_SIZE or len(payload) > PAYLOAD_SIZE:
+            raise ValueError("Message too long to queue: {} bytes topic, {} bytes payload".format(
+                len(topic), len(payload)))
+        self.lock.acquire()
+        try:
+            seq = self.head
+            if seq - self.tail >= self.capacity:
+                # Full, overwrite the oldest message
+                self.sent.discard(self.tail)
+                self.acked.discard(self.tail)
+                self.tail += 1
+                self.dropped += 1
+            self.file.seek(self._slot(seq))
+            self.file.write(RECORD.pack(
+                seq, mono, wall, topic, payload
+            ))
+            self.head = seq + 1
+            self._write_header()
+            self._flush()
+            return seq
+        finally:
+            self.lock.release()
+
+    def unsent(self, limit):
+        """ Return up to limit queued messages not yet published """
+        records = []
+        self.lock.acquire()
+        try:
+            seq = self.tail
+            while seq < self.head and len(records) < limit:
+                if seq not in self.sent and seq not in self.acked:
+                    records.append(self._read(seq))
+                seq += 1
+        finally:
+            self.lock.release()
+        return records
+
+    def mark_sent(self, seq):
+        """ Message has been handed to the MQTT client """
+        self.lock.acquire()
+        try:
+            if seq >= self.tail:
+                self.sent.add(seq)
+        finally:
+            self.lock.release()
+
+    def ack(self, seq):
+        """ Broker acknowledged a message, release its slot """
+        self.lock.acquire()
+        try:
+            self.sent.discard(seq)
+            if seq < self.tail:
+                return
+            self.acked.add(seq)
+            moved = False
+            while self.tail in self.acked:
+                self.acked.discard(self.tail)
+                self.tail += 1
+                moved = True
+            if moved:
+                self._write_header()
+                self._flush()
+        finally:
+            self.lock.release()
+
+    def in_flight(self):
+        """ Number of messages published but not acknowledged """
+        return len(self.sent)
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def close(self):
+        # Last fsync first, the sync thread exits once it is done
+        self.closed = True
+        self.dirty.set()
+        if self.sync_thread is not None:
+            self.sync_thread.join()
+        self.lock.acquire()
+        try:
+            self.file.close()
+        finally:
+            self.lock.release()
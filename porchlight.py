@@ -1,22 +1,33 @@
 #!/usr/bin/env python3
-import time
 import ledstrip
 import threading
-from pixelpi import Strip
-import paho.mqtt.client as mqtt
+import transport
+import events
+import clocks
+import metrics
 
-MQTT_HOST = "localhost"
-MQTT_PORT = 1883
-MQTT_KEEPALIVE = 120
 MQTT_CLIENT_ID = "front_door_lights"
 MQTT_TOPIC = "event/porchlight"
-MQTT_USER = ""
-MQTT_PASS = ""
+MQTT_PING_TOPIC = "connection/ping"
+MQTT_REPLY_TOPIC = "connection/reply"
+MQTT_EXPIRED_TOPIC = "status/front_door_lights/expired"
+MQTT_STARTUP_TOPIC = "status/front_door_lights/startup"
+# Stamped commands older than this (seconds) are ignored
+EVENT_TTL = events.EVENT_TTL
 
 class PorchLight():
 
-    def __init__(self):
+    def __init__(self, client=None, clock=None):
         # Constructor
+        # Pass an eventbus client to run in co-located mode,
+        # and a virtual clock to simulate days in seconds
+        # Time from process start to the first on/off decision
+        self.startup = metrics.StartupTimer(MQTT_CLIENT_ID)
+        self.clock = clock
+        if self.clock is None:
+            self.clock = clocks.SYSTEM_CLOCK
+        # Seconds between checks of the on/off time
+        self.check_interval = 1
         # Member Vars
         self.DEBUG = False
         # Time for LED to turn ON
@@ -29,41 +40,59 @@ class PorchLight():
         self.lock = threading.Lock()
         self.exit = False  # flag set when we want the process to exit
         self.brightness = 255  # 0 - 255
+
+        # Create empty LED strip array
+        self.channel = []
+        # Set once the strips are set up, commands that need them wait
+        self.ready = threading.Event()
+
+        # If set 1, lights will turn on
+        # if set 0, lights will turn off
+        # if set -1, lights will revert to auto
+        self.manual_override = -1
+
+        # MQTT Initialisation
+        self.transport = transport.Transport(MQTT_CLIENT_ID, client)
+        self.log = self.transport.log
+        # Commands too old to act on, e.g. a backlog after a reconnect
+        self.expired = metrics.DropCounter("expired")
+        self.transport.subscribe(MQTT_TOPIC, self.on_command)
+        self.transport.subscribe(MQTT_PING_TOPIC, self.on_ping)
+        self.transport.connect_hooks.append(self.on_connect)
+        # Connect while the strips are set up
+        self.transport.start()
+
+        # Imported here so it loads while connecting
+        from pixelpi import Strip
         # "WS2812", "SK6812", "SK6812W", "SK6812_RGBW", "SK6812_RBGW", "SK6812_GRBW", "SK6812_GBRW", "SK6812_BRGW", "SK6812_BGRW", "WS2811_RGB", "WS2811_RBG", "WS2811_GRB", "WS2811_GBR", "WS2811_BRG", "WS2811_BGR"
         self.strip1 = Strip(terminal=2, size=5, shape='straight', ledtype='WS2812', brightness=self.brightness)
         self.strip2 = Strip(terminal=3, size=20, shape='straight', ledtype='WS2812', brightness=self.brightness)
         self.strip3 = Strip(terminal=4, size=150, shape='straight', ledtype='WS2812', brightness=self.brightness)
 
-        # Create empty LED strip array
-        self.channel = []
-
         # Add Red Channel LED strip (5 leds shown above)
-        led_strip_1 = ledstrip.LedStrip(self.strip1)
+        led_strip_1 = ledstrip.LedStrip(self.strip1, clock=self.clock)
         self.channel.append(led_strip_1)
         # Second LED Strip
-        led_strip_2 = ledstrip.LedStrip(self.strip2, allow_seasonal_display=True)
+        led_strip_2 = ledstrip.LedStrip(self.strip2, allow_seasonal_display=True, clock=self.clock)
         self.channel.append(led_strip_2)
         # Third LED Strip
-        led_strip_3 = ledstrip.LedStrip(self.strip3, allow_seasonal_display=True)
+        led_strip_3 = ledstrip.LedStrip(self.strip3, allow_seasonal_display=True, clock=self.clock)
         #led_strip_3.led_mode = led_strip_3.led_mode_three_spots
         led_strip_3.led_mode = led_strip_3.led_mode_every_third
         self.channel.append(led_strip_3)
+        self.ready.set()
+        self.startup.mark("strips")
 
-        # If set 1, lights will turn on
-        # if set 0, lights will turn off
-        # if set -1, lights will revert to auto
-        self.manual_override = -1
+    def on_connect(self):
+        self.startup.mark("mqtt")
+        self.report_startup()
 
-        # MQTT Initialisation
-        self.client = mqtt.Client(client_id=MQTT_CLIENT_ID, clean_session=False)
-        self.client.username_pw_set(MQTT_USER, MQTT_PASS)
-        self.client.on_message = self.on_message
-        self.client.on_connect = self.on_connect
-        self.client.on_publish = self.on_publish
-        self.client.on_subscribe = self.on_subscribe
-
-        self.client.connect(MQTT_HOST, MQTT_PORT, MQTT_KEEPALIVE)
-        self.client.loop_start() # Start the MQTT client
+    def report_startup(self):
+        """ Publish the startup times, retained, once ready and connected """
+        if self.startup.complete(["ready", "mqtt"]):
+            summary = self.startup.format_summary()
+            self.log.info("Started, {}", summary)
+            self.transport.publish(MQTT_STARTUP_TOPIC, summary, retain=True)
 
     def set_exit(self):
         # Grab the lock to the list of sockets
@@ -109,7 +138,7 @@ class PorchLight():
     def shouldBeOn(self, timeNow):
         """ Returns whether lights should be on or off  """
         if self.DEBUG:
-            print("HH:MM", timeNow.tm_hour, ':', timeNow.tm_min, timeNow.tm_sec)
+            self.log.debug("HH:MM {}:{} {}", timeNow.tm_hour, timeNow.tm_min, timeNow.tm_sec)
 
         if self.manual_override == 0:
             return False
@@ -146,7 +175,7 @@ class PorchLight():
     def is_in_date_range(self, start_month, start_day, end_month, end_day):
         """ Test whether todays date is within the given date range """
         # Get current date
-        date = time.localtime()
+        date = self.clock.localtime()
 
         # Is start month greater than end month
         straddling_year_end = False
@@ -173,63 +202,68 @@ class PorchLight():
         else:
             return False
 
-    def on_connect(self, mqttc, obj, flags, rc):
-        print("Connected, rc: "+str(rc))
-        self.client.subscribe(MQTT_TOPIC, qos=1)
-
-    def on_message(self, mqttc, obj, message):
-        print(message.topic+" "+str(message.qos)+" "+str(message.payload))
-        topic = str(message.topic)
-        message = str(message.payload.decode("utf-8"))
-        # print(topic + message)
-        if topic == MQTT_TOPIC:
-            if message == "ON":
-                # We want lights to turn on now
-                self.manual_override = 1
-            if message == "OFF":
-                # We want lights to turn off now
-                self.manual_override = 0
-            if message == "AUTO":
-                # We want lights to turn off now
-                self.manual_override = -1
-            if message == "PARTY":
-                # Ensure lights are off to start
-                for item in self.channel:
-                    if item.allow_seasonal_display:
-                        # Turn light OFF
-                        item.switch_off()
-                self.manual_override = 1
-                for item in self.channel:
-                    if item.allow_seasonal_display:
-                        # Then turn on party mode
-                        item.switch_on_party_mode()
-
-    def on_publish(self, mqttc, obj, mid):
-        print("mid: "+str(mid))
-
-    def on_subscribe(self, mqttc, obj, mid, granted_qos):
-        print("Subscribed: "+str(mid)+" "+str(granted_qos))
-
-    def on_log(self, mqttc, obj, level, string):
-        print(string)
+    def on_ping(self, topic, message, raw):
+        """ connection/ping received """
+        message, fields = events.decode(message)
+        if message == "PING":
+            self.transport.publish(MQTT_REPLY_TOPIC, events.ping_reply(MQTT_CLIENT_ID, fields))
+
+    def on_command(self, topic, message, raw):
+        """ event/porchlight received """
+        # Apps send plain commands, which never expire
+        message, fields = events.decode(message)
+        now = self.clock.time()
+        if events.expired(fields, EVENT_TTL, now):
+            age = events.age(fields, now)
+            self.expired.drop(message, age)
+            self.log.info("Dropped {} {:.1f}s old", message, age)
+            self.transport.publish(MQTT_EXPIRED_TOPIC, self.expired.format_summary(), retain=True)
+            return
+        if message == "ON":
+            # We want lights to turn on now
+            self.manual_override = 1
+        if message == "OFF":
+            # We want lights to turn off now
+            self.manual_override = 0
+        if message == "AUTO":
+            # We want lights to turn off now
+            self.manual_override = -1
+        if message == "PARTY":
+            # Only waits for a command delivered as we start up
+            self.ready.wait()
+            # Ensure lights are off to start
+            for item in self.channel:
+                if item.allow_seasonal_display:
+                    # Turn light OFF
+                    item.switch_off()
+            self.manual_override = 1
+            for item in self.channel:
+                if item.allow_seasonal_display:
+                    # Then turn on party mode
+                    item.switch_on_party_mode()
 
     def run(self):
         while True:
             try:
-                # Ensure lights are off to start
+                # Ensure lights are off to start. Dark strips (e.g.
+                # after a power cut) are cleared at once, not faded
                 for item in self.channel:
-                    # Turn light OFF
-                    item.switch_off()
+                    if item.is_on():
+                        # Turn light OFF
+                        item.switch_off()
+                    else:
+                        item.blank()
 
                 # Loop indefinitely
                 prev_should_be_on = False
+                started = False
                 while True:
                     # Check exit flag on each loop
                     if self.is_exit():
                         return
 
                     # Get the time now
-                    timeNow = time.localtime()
+                    timeNow = self.clock.localtime()
 
                     # Find out if the LEDS should be on
                     shouldBeOn = self.shouldBeOn(timeNow)
@@ -267,10 +301,16 @@ class PorchLight():
                             # Turn light OFF
                             item.switch_off()
 
+                    if not started:
+                        # First on/off decision made, lights usable
+                        started = True
+                        self.log.info("Ready in {:.2f}s", self.startup.mark("ready"))
+                        self.report_startup()
+
                     # Sleep for a minute and test again.
                     # NOTE: will always normalise the tick to round minutes
                     #time.sleep(60 - timeNow.tm_sec)
-                    time.sleep(1)  # Simply check on/off status once a second. Should be no extra load
+                    self.clock.sleep(self.check_interval)  # Simply check on/off status once a second. Should be no extra load
                     # Finally, remember the "should be on" state
                     prev_should_be_on = shouldBeOn
             except (KeyboardInterrupt, SystemExit):
@@ -283,7 +323,7 @@ if __name__=="__main__":
     lights = PorchLight()
     try:
         rc = lights.run()
-        print("rc: " + str(rc))
+        lights.log.info("rc: {}", rc)
 
     except:
         # Quitting, ensure lights are off
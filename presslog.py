@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+import os
+import time
+import struct
+import threading
+
+# Press record: wall time, hold duration, edge to publish latency
+RECORD = struct.Struct("<ddf")
+# Index entry: latest wall time of any record before a block, block
+# number. Kept in append order, so a clock stepping back can not hide
+# a press from a query
+INDEX = struct.Struct("<dI")
+# Records per index block
+BLOCK_RECORDS = 64
+# One segment file per day, named by date
+SEGMENT_SUFFIX = ".presses"
+INDEX_SUFFIX = ".idx"
+SECONDS_PER_DAY = 24 * 60 * 60
+# Most days a query may cover
+MAX_QUERY_DAYS = 366
+
+
+# Append only log of doorbell presses. Records are fixed size and
+# written to one segment per day, so a query only opens the days it
+# covers and streams them without loading everything into memory.
+class PressLog():
+
+    def __init__(self, folder):
+        # Constructor
+        self.folder = folder
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        # Currently open segment
+        self.segment_name = None
+        self.segment_file = None
+        self.index_file = None
+        self.segment_records = 0
+        self.segment_latest = None
+        # Thread lock
+        self.lock = threading.Lock()
+
+    def segment_for(self, wall):
+        """ Segment name for a given wall time, e.g. 2024-12-25 """
+        return time.strftime("%Y-%m-%d", time.localtime(wall))
+
+    def _path(self, name, suffix):
+        return os.path.join(self.folder, name + suffix)
+
+    def _rotate(self, name):
+        """ Close the current segment and open (or continue) another """
+        if self.segment_file is not None:
+            self.segment_file.close()
+            self.index_file.close()
+        path = self._path(name, SEGMENT_SUFFIX)
+        index_path = self._path(name, INDEX_SUFFIX)
+        records = 0
+        self.segment_latest = None
+        if os.path.isfile(path):
+            # Cut off a record left half written by a crash, so the
+            # ones appended after it stay aligned
+            records = os.path.getsize(path) // RECORD.size
+            os.truncate(path, records * RECORD.size)
+            f = open(path, "rb")
+            try:
+                for wall, held, latency in RECORD.iter_unpack(f.read()):
+                    if self.segment_latest is None or wall > self.segment_latest:
+                        self.segment_latest = wall
+            finally:
+                f.close()
+        if os.path.isfile(index_path):
+            # Likewise for the index, keeping one entry per block
+            blocks = (records + BLOCK_RECORDS - 1) // BLOCK_RECORDS
+            entries = min(os.path.getsize(index_path) // INDEX.size, blocks)
+            os.truncate(index_path, entries * INDEX.size)
+        self.segment_file = open(path, "ab")
+        self.index_file = open(index_path, "ab")
+        self.segment_records = records
+        self.segment_name = name
+
+    def append(self, wall, held, latency):
+        """ Record a single press """
+        self.lock.acquire()
+        try:
+            name = self.segment_for(wall)
+            if name != self.segment_name:
+                # Daily rotation
+                self._rotate(name)
+            if self.segment_records % BLOCK_RECORDS == 0:
+                # Start of a new block, add it to the time index
+                latest = self.segment_latest
+                if latest is None:
+                    latest = wall
+                self.index_file.write(INDEX.pack(
+                    latest, self.segment_records // BLOCK_RECORDS
+                ))
+                self.index_file.flush()
+            self.segment_file.write(RECORD.pack(wall, held, latency))
+            self.segment_file.flush()
+            self.segment_records += 1
+            if self.segment_latest is None or wall > self.segment_latest:
+                self.segment_latest = wall
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.segment_file is not None:
+                self.segment_file.close()
+                self.index_file.close()
+                self.segment_file = None
+                self.index_file = None
+                self.segment_name = None
+        finally:
+            self.lock.release()
+
+    def segments(self, start, end):
+        """ Names of the segments that may hold presses in [start, end) """
+        # Only the segments that exist are looked at, however long the
+        # range. Names are dates, so they sort and compare in order
+        first = self.segment_for(start)
+        last = self.segment_for(end)
+        names = []
+        for entry in sorted(os.listdir(self.folder)):
+            if not entry.endswith(SEGMENT_SUFFIX):
+                continue
+            name = entry[:-len(SEGMENT_SUFFIX)]
+            if first <= name <= last:
+                names.append(name)
+        return names
+
+    def _first_block(self, name, start):
+        """ Use the time index to skip blocks entirely before start """
+        block = 0
+        path = self._path(name, INDEX_SUFFIX)
+        if not os.path.isfile(path):
+            return 0
+        f = open(path, "rb")
+        try:
+            while True:
+                data = f.read(INDEX.size)
+                if len(data) < INDEX.size:
+                    break
+                latest, number = INDEX.unpack(data)
+                if latest >= start:
+                    # A block before this one may hold a press in range
+                    break
+                block = number
+        finally:
+            f.close()
+        return block
+
+    def presses(self, start, end):
+        """ Yield (wall, held, latency) for every press in [start, end) """
+        for name in self.segments(start, end):
+            block = self._first_block(name, start)
+            f = open(self._path(name, SEGMENT_SUFFIX), "rb")
+            try:
+                f.seek(block * BLOCK_RECORDS * RECORD.size)
+                while True:
+                    data = f.read(RECORD.size * BLOCK_RECORDS)
+                    if len(data) < RECORD.size:
+                        break
+                    # Ignore a partially written trailing record
+                    usable = len(data) - (len(data) % RECORD.size)
+                    for wall, held, latency in RECORD.iter_unpack(data[:usable]):
+                        # Not in time order if the clock was stepped
+                        if wall >= start and wall < end:
+                            yield wall, held, latency
+            finally:
+                f.close()
+
+    def count(self, start, end):
+        """ Number of presses in [start, end) """
+        total = 0
+        for press in self.presses(start, end):
+            total += 1
+        return total
+
+    def per_hour_of_day(self, days=30, now=None):
+        """ Presses per hour of day (0-23) over the last few days """
+        if now is None:
+            now = time.time()
+        counts = [0] * 24
+        for wall, held, latency in self.presses(now - days * SECONDS_PER_DAY, now):
+            counts[time.localtime(wall).tm_hour] += 1
+        return counts
+
+    def per_day(self, days=30, now=None):
+        """ Presses per day as a list of (date, count), oldest first """
+        if now is None:
+            now = time.time()
+        start = now - days * SECONDS_PER_DAY
+        result = []
+        for name in self.segments(start, now):
+            size = os.path.getsize(self._path(name, SEGMENT_SUFFIX))
+            # Whole days can be counted from the file size alone
+            if name != self.segment_for(start) and name != self.segment_for(now):
+                result.append((name, size // RECORD.size))
+            else:
+                day_start = time.mktime(time.strptime(name, "%Y-%m-%d"))
+                result.append((name, self.count(
+                    max(start, day_start), min(now, day_start + SECONDS_PER_DAY)
+                )))
+        return result
+
+    def hold_stats(self, days=30, now=None):
+        """ Count, mean hold and mean latency over the last few days """
+        if now is None:
+            now = time.time()
+        count = 0
+        held_total = 0.0
+        latency_count = 0
+        latency_total = 0.0
+        for wall, held, latency in self.presses(now - days * SECONDS_PER_DAY, now):
+            count += 1
+            held_total += held
+            # Negative latency means the press was queued while offline
+            if latency >= 0:
+                latency_count += 1
+                latency_total += latency
+        result = {"count": count, "held": None, "latency": None}
+        if count > 0:
+            result["held"] = round(held_total / count, 3)
+        if latency_count > 0:
+            result["latency"] = round(latency_total / latency_count, 6)
+        return result
+
+    def query(self, request):
+        """ Answer a text query, as received over MQTT.
+        "HOURLY [days]", "DAILY [days]" or "STATS [days]" """
+        parts = request.split()
+        if len(parts) == 0:
+            return "ERROR empty query"
+        days = 30
+        if len(parts) > 1:
+            try:
+                days = int(parts[1])
+            except ValueError:
+                return "ERROR bad day count"
+            if days < 1 or days > MAX_QUERY_DAYS:
+                return "ERROR day count must be 1-{}".format(MAX_QUERY_DAYS)
+        command = parts[0].upper()
+        if command == "HOURLY":
+            counts = self.per_hour_of_day(days)
+            return "HOURLY " + " ".join(
+                "{:02d}={}".format(hour, counts[hour]) for hour in range(24)
+            )
+        if command == "DAILY":
+            return "DAILY " + " ".join(
+                "{}={}".format(name, count) for name, count in self.per_day(days)
+            )
+        if command == "STATS":
+            stats = self.hold_stats(days)
+            return "STATS count={} held={} latency={}".format(
+                stats["count"], stats["held"], stats["latency"]
+            )
+        return "ERROR unknown query " + parts[0]
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import threading
+from collections import OrderedDict
+import clocks
+import metrics
+
+# Sources tracked separately, the least recently seen is forgotten
+# beyond this so made up source names can not use up memory
+MAX_SOURCES = 32
+# Source of events that do not say where they came from
+UNKNOWN_SOURCE = "unknown"
+# Counted under this once MAX_SOURCES have been counted
+OTHER_SOURCE = "other"
+
+
+class TokenBucket():
+
+    def __init__(self, rate, burst, clock=None):
+        # Constructor
+        # Tokens added per second, and the most that can be saved up
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        if self.clock is None:
+            self.clock = clocks.SYSTEM_CLOCK
+        self.tokens = self.burst
+        self.last = self.clock.monotonic()
+
+    def take(self, now=None):
+        """ Use a token if there is one. Returns False if over the limit """
+        if now is None:
+            now = self.clock.monotonic()
+        if now > self.last:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+# Rate limit for events from many sources: each source has its own
+# bucket and all of them share an overall one, so neither a single
+# noisy client nor many together can ring faster than the limits.
+# Costs a dict lookup and some arithmetic per event however fast
+# they arrive.
+class RateLimiter():
+
+    def __init__(self, rate, burst, source_rate=None, source_burst=None, clock=None):
+        # Constructor
+        self.clock = clock
+        if self.clock is None:
+            self.clock = clocks.SYSTEM_CLOCK
+        self.overall = TokenBucket(rate, burst, self.clock)
+        self.source_rate = source_rate
+        self.source_burst = source_burst
+        # Bucket of each source, least recently seen first
+        self.sources = OrderedDict()
+        # Events passed by source
+        self.allowed = {}
+        # Events over the limit, by source
+        self.suppressed = metrics.DropCounter("suppressed")
+        # Thread lock
+        self.lock = threading.Lock()
+
+    def allow(self, source=None):
+        """ Should an event from this source go ahead """
+        if not source:
+            source = UNKNOWN_SOURCE
+        now = self.clock.monotonic()
+        self.lock.acquire()
+        try:
+            allowed = True
+            if self.source_rate is not None:
+                bucket = self.sources.get(source)
+                if bucket is None:
+                    if len(self.sources) >= MAX_SOURCES:
+                        self.sources.popitem(last=False)
+                    bucket = TokenBucket(self.source_rate, self.source_burst, self.clock)
+                    self.sources[source] = bucket
+                else:
+                    self.sources.move_to_end(source)
+                allowed = bucket.take(now)
+            # A source over its own limit does not use up the overall one
+            if allowed:
+                allowed = self.overall.take(now)
+            if allowed:
+                name = source
+                if name not in self.allowed and len(self.allowed) >= MAX_SOURCES:
+                    name = OTHER_SOURCE
+                self.allowed[name] = self.allowed.get(name, 0) + 1
+            else:
+                name = source
+                if name not in self.suppressed.counts and len(self.suppressed.counts) >= MAX_SOURCES:
+                    name = OTHER_SOURCE
+        finally:
+            self.lock.release()
+        if not allowed:
+            self.suppressed.drop(name)
+        return allowed
+
+    def format_summary(self):
+        """ Return a single human readable summary line """
+        self.lock.acquire()
+        try:
+            allowed = sorted(self.allowed.items())
+        finally:
+            self.lock.release()
+        return "allowed: {} | {}".format(
+            " ".join("{}={}".format(k, v) for k, v in allowed),
+            self.suppressed.format_summary()
+        )
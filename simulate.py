@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# Runs the porchlight on a virtual clock, on fake LED strips, so long
+# stretches of time take seconds.
+#
+#   schedule  - a PorchLight deciding on/off and seasonal modes, e.g. a
+#               year from 2026-01-01 checking once a minute
+#   animation - one LED strip running an effect, counting frames
+#
+# e.g. python3 simulate.py schedule --days 365 --start 2026-01-01
+#      python3 simulate.py animation --mode christmas --minutes 60
+import sys
+import time
+import argparse
+import threading
+import fakes
+
+# Must be in place before porchlight imports pixelpi
+fakes.install()
+
+import clocks
+import eventbus
+import ledstrip
+import porchlight
+
+SECONDS_PER_DAY = 24 * 60 * 60
+# Animation modes, each a LedStrip mode switched on for the run.
+# Party mode never sleeps, so it can not be run on a virtual clock
+ANIMATIONS = ["christmas", "swipe", "every_third", "standard"]
+
+
+def parse_date(text):
+    return time.mktime(time.strptime(text, "%Y-%m-%d"))
+
+
+def simulate_schedule(args):
+    clock = clocks.VirtualClock(parse_date(args.start))
+    bus = eventbus.EventBus(mirror=False)
+    lights = porchlight.PorchLight(
+        client=bus.local_client(porchlight.MQTT_CLIENT_ID), clock=clock
+    )
+    lights.check_interval = args.interval
+    seasonal = [item for item in lights.channel if item.allow_seasonal_display][0]
+
+    # Every change in (on, seasonal mode), recorded as the run loop decides
+    changes = []
+    decisions = [0]
+    should_be_on = lights.shouldBeOn
+
+    def recorded(timeNow):
+        result = should_be_on(timeNow)
+        decisions[0] += 1
+        state = (result, seasonal.led_mode)
+        if len(changes) == 0 or changes[-1][1] != state:
+            changes.append((clock.time(), state))
+        return result
+    lights.shouldBeOn = recorded
+
+    mode_names = {
+        seasonal.led_mode_standard: "standard",
+        seasonal.led_mode_christmas: "christmas",
+        seasonal.led_mode_every_third: "every_third",
+        seasonal.led_mode_three_spots: "three_spots",
+    }
+
+    time_start = time.monotonic()
+    thread = threading.Thread(target=lights.run)
+    thread.daemon = True
+    thread.start()
+    clock.participate(thread)
+    clock.sleep(args.days * SECONDS_PER_DAY)
+    lights.set_exit()
+    # Let the run loop (and any display thread) see the exit flag
+    clock.sleep(args.interval * 2)
+    clock.leave()
+    thread.join(5)
+    real = time.monotonic() - time_start
+
+    switched_on = 0
+    for n in range(1, len(changes)):
+        if changes[n][1][0] and not changes[n - 1][1][0]:
+            switched_on += 1
+    if args.verbose:
+        for when, (on, mode) in changes:
+            print("{} {} {}".format(
+                time.strftime("%Y-%m-%d %H:%M", clock.localtime(when)),
+                "ON " if on else "OFF", mode_names.get(mode, mode)
+            ))
+    seasons = []
+    for when, (on, mode) in changes:
+        if mode == seasonal.led_mode_christmas:
+            day = time.strftime("%Y-%m-%d", clock.localtime(when))
+            if len(seasons) == 0 or seasons[-1][1] != day:
+                seasons.append((when, day))
+    print("{} days, {} decisions in {:.2f}s ({:.0f} per second)".format(
+        args.days, decisions[0], real, decisions[0] / max(0.001, real)))
+    print("  {} changes of state, {} of them switching on".format(
+        len(changes), switched_on))
+    print("  christmas mode on {} days, first {}, last {}".format(
+        len(seasons),
+        seasons[0][1] if seasons else "-",
+        seasons[-1][1] if seasons else "-"))
+
+
+def simulate_animation(args):
+    clock = clocks.VirtualClock()
+    strip = fakes.FakeStrip(size=args.leds)
+    led = ledstrip.LedStrip(strip, allow_seasonal_display=True, clock=clock)
+    displays = {"christmas": led.christmas_display_1, "swipe": led.christmas_display_2}
+
+    time_start = time.monotonic()
+    cpu_start = time.process_time()
+    seconds = args.minutes * 60
+    if args.mode in displays:
+        # As switch_on does in christmas mode, with the chosen display
+        led.led_mode = led.led_mode_christmas
+        led.exit = False
+        led.led_thread = threading.Thread(target=displays[args.mode])
+        led.led_thread.start()
+        clock.participate(led.led_thread)
+        led.set_on(True)
+        clock.sleep(seconds)
+        led.switch_off()
+        # Display thread notices the exit flag on its next wake
+        clock.sleep(1.0)
+    else:
+        # Static modes only animate while switching, so keep switching
+        if args.mode == "every_third":
+            led.led_mode = led.led_mode_every_third
+        else:
+            led.led_mode = led.led_mode_standard
+        time_end = clock.monotonic() + seconds
+        while clock.monotonic() < time_end:
+            led.switch_on()
+            clock.sleep(1.0)
+            led.switch_off()
+            clock.sleep(1.0)
+    clock.leave()
+    real = time.monotonic() - time_start
+    cpu = time.process_time() - cpu_start
+    print("{} on {} LEDs, {} virtual minutes in {:.2f}s".format(
+        args.mode, args.leds, args.minutes, real))
+    print("  {} frames ({:.1f} per virtual second), {:.3f}ms CPU per frame".format(
+        strip.shows, strip.shows / max(1.0, seconds),
+        cpu * 1000.0 / max(1, strip.shows)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the porchlight on a virtual clock")
+    commands = parser.add_subparsers(dest="command")
+    schedule = commands.add_parser("schedule", help="on/off and seasonal decisions")
+    schedule.add_argument("--start", default=time.strftime("%Y-%m-%d"), help="first day, YYYY-MM-DD")
+    schedule.add_argument("--days", type=float, default=365)
+    schedule.add_argument("--interval", type=float, default=60,
+                          help="seconds between checks, the daemon uses 1")
+    schedule.add_argument("--verbose", action="store_true", help="print every change")
+    animation = commands.add_parser("animation", help="frames of an LED effect")
+    animation.add_argument("--mode", choices=ANIMATIONS, default="christmas")
+    animation.add_argument("--minutes", type=float, default=60)
+    animation.add_argument("--leds", type=int, default=150)
+    args = parser.parse_args()
+    if args.command == "schedule":
+        simulate_schedule(args)
+    elif args.command == "animation":
+        simulate_animation(args)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
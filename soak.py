@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# Soak and load test for the button, ringer and porchlight together.
+#
+# Runs all three daemons in one process on a fake GPIO, fake pixelpi
+# strips and an in-process broker stand-in, then loads them with
+#   button storms  - bursts of bouncy presses on the doorbell pins
+#   command floods - dashboard ON/OFF/AUTO and tune set changes
+#   PING sweeps    - timed connection/ping to every device
+# and reports, every --report seconds and at the end,
+#   throughput     - messages the broker delivered per second
+#   latency        - ring (edge to first audio block, from the ring
+#                    traces), PING round trips and broker delivery
+#   threads        - current and peak thread count
+#   memory         - RSS and live Python objects, and their growth
+#
+# e.g. python3 soak.py --duration 7200 --report 300
+import os
+import sys
+import gc
+import math
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import wave
+import struct
+import fakes
+
+# Must be in place before the daemons import RPi.GPIO and pixelpi
+GPIO = fakes.install()
+
+import audio
+import events
+import logger
+import metrics
+import tracing
+import transport
+import eventbus
+import benchmark_ringer
+import doorbell_button
+import doorbell_ringer
+import porchlight
+
+MQTT_CLIENT_ID = "soak"
+COMMAND_TOPIC = porchlight.MQTT_TOPIC
+TUNE_TOPIC = "event/doorbell_tune"
+DEVICES = [
+    doorbell_button.MQTT_CLIENT_ID,
+    doorbell_ringer.MQTT_CLIENT_ID,
+    porchlight.MQTT_CLIENT_ID
+]
+# Window of each latency recorder
+SAMPLES = 100000
+
+
+def rss_bytes():
+    """ Resident memory of this process, 0 if unknown """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def write_tone(filename, frequency, duration=0.3, rate=audio.ENGINE_RATE):
+    """ Short sine tone, so the harness needs no sound files """
+    frames = int(duration * rate)
+    f = wave.open(filename, "wb")
+    try:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        samples = [
+            int(8000 * math.sin(2 * math.pi * frequency * n / rate))
+            for n in range(frames)
+        ]
+        f.writeframes(struct.pack("<{}h".format(frames), *samples))
+    finally:
+        f.close()
+
+
+class TimedBroker(benchmark_ringer.BrokerStandIn):
+
+    def __init__(self):
+        # Broker stand in that also times its deliveries
+        self.delivered = 0
+        self.delivery = metrics.LatencyRecorder("broker", window=SAMPLES)
+        benchmark_ringer.BrokerStandIn.__init__(self)
+
+    def publish(self, topic, payload):
+        self.queue.put((eventbus.Message(topic, payload, 1), time.monotonic()))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            message, time_queued = item
+            self.bus.dispatch(message)
+            self.delivered += 1
+            # Includes the time the subscribers' handlers took
+            self.delivery.record(time.monotonic() - time_queued)
+
+
+class Soak():
+
+    def __init__(self, args):
+        # Constructor
+        self.args = args
+        self.killed = False
+        self.folder = tempfile.mkdtemp(prefix="doorbell_soak_")
+        self.setup_files()
+
+        self.broker = TimedBroker()
+        # Local publishes are delivered straight away and not queued,
+        # count them too for throughput
+        self.local_messages = 0
+        publish = self.broker.bus.publish
+
+        def counted_publish(topic, payload=None, qos=0, retain=False, on_mirrored=None):
+            self.local_messages += 1
+            publish(topic, payload, qos, retain, on_mirrored)
+        self.broker.bus.publish = counted_publish
+
+        self.button = doorbell_button.DoorBell_Button(
+            GPIO, client=self.broker.client(doorbell_button.MQTT_CLIENT_ID)
+        )
+        self.ringer = doorbell_ringer.DoorBell_Ringer(
+            client=self.broker.client(doorbell_ringer.MQTT_CLIENT_ID),
+            sink=audio.NullSink(realtime=True)
+        )
+        self.lights = porchlight.PorchLight(
+            client=self.broker.client(porchlight.MQTT_CLIENT_ID)
+        )
+
+        # Our own view of the traffic
+        self.ring = metrics.LatencyRecorder("ring", window=SAMPLES)
+        self.ping_rtt = {}
+        for name in DEVICES:
+            self.ping_rtt[name] = metrics.LatencyRecorder("ping_" + name, window=SAMPLES)
+        self.ping_seq = 0
+        self.ping_sent = {}
+        # Earliest span start of each ring, by trace ID
+        self.trace_starts = {}
+        self.presses = 0
+        self.commands = 0
+        self.lock = threading.Lock()
+        self.transport = transport.Transport(MQTT_CLIENT_ID, self.broker.client(MQTT_CLIENT_ID))
+        self.log = self.transport.log
+        self.transport.subscribe(tracing.SPAN_TOPIC, self.on_span, 0)
+        self.transport.subscribe(doorbell_ringer.MQTT_TOPIC[3][0], self.on_reply)
+        self.transport.start()
+
+        # Starting point for growth
+        gc.collect()
+        self.time_start = time.monotonic()
+        self.rss_start = rss_bytes()
+        self.objects_start = len(gc.get_objects())
+        self.threads_start = threading.active_count()
+        self.threads_peak = self.threads_start
+
+    def setup_files(self):
+        """ Point every daemon's files at a scratch folder """
+        sounds = os.path.join(self.folder, "sounds")
+        os.makedirs(sounds)
+        write_tone(os.path.join(sounds, "ding.wav"), 660)
+        write_tone(os.path.join(sounds, "dong.wav"), 550)
+        doorbell_ringer.SOUNDS_FOLDER = sounds
+        doorbell_button.QUEUE_FILE = os.path.join(self.folder, "outbound.queue")
+        doorbell_button.PRESS_LOG_FOLDER = os.path.join(self.folder, "presses")
+        doorbell_button.SYNC_PLAY_DELAY = self.args.sync_delay
+        # Front door plus any extra inputs, each on the next pin
+        doorbell_button.INPUTS_FILE = None
+        doorbell_button.INPUTS = [{"name": "front", "pin": 23, "topic": "event/doorbell"}]
+        for n in range(1, self.args.inputs):
+            doorbell_button.INPUTS.append({
+                "name": "in{}".format(n), "pin": 23 + n,
+                "topic": "event/doorbell/in{}".format(n)
+            })
+
+    def on_span(self, topic, message, raw):
+        """ Ring latency from the ring traces, edge to first audio """
+        name, fields = events.decode(message)
+        trace_id = fields.get(tracing.TRACE_FIELD)
+        start = events.field_float(fields, "start")
+        end = events.field_float(fields, "end")
+        if trace_id is None or start is None or end is None:
+            return
+        self.lock.acquire()
+        try:
+            first = min(start, self.trace_starts.get(trace_id, start))
+            self.trace_starts[trace_id] = first
+            if fields.get("stage") == "audio":
+                del self.trace_starts[trace_id]
+                self.ring.record(end - first)
+            # Rings that never played must not build up
+            if len(self.trace_starts) > 1000:
+                self.trace_starts.clear()
+        finally:
+            self.lock.release()
+
+    def on_reply(self, topic, message, raw):
+        time_now = time.monotonic()
+        name, fields = events.decode(message)
+        if fields.get("to") != MQTT_CLIENT_ID or name not in self.ping_rtt:
+            return
+        self.lock.acquire()
+        try:
+            sent = self.ping_sent.get(fields.get("seq"))
+        finally:
+            self.lock.release()
+        if sent is not None:
+            self.ping_rtt[name].record(time_now - sent)
+
+    # ---- load ----
+
+    def storms(self):
+        """ Bursts of presses, some too close together or bouncy """
+        pins = [item.pin for item in self.button.inputs]
+        while not self.killed:
+            for n in range(self.args.storm_size):
+                if self.killed:
+                    return
+                GPIO.press(
+                    random.choice(pins),
+                    held=random.uniform(0.03, 0.3),
+                    bounces=random.randint(0, 3)
+                )
+                self.presses += 1
+                time.sleep(random.uniform(0.05, 1.5))
+            self.sleep(self.args.storm_every)
+
+    def floods(self):
+        """ Dashboard commands as fast as an app could send them """
+        commands = self.args.commands.split(",")
+        tunes = [doorbell_ringer.DEFAULT_TUNE_SET, "default"]
+        while not self.killed:
+            time_end = time.monotonic() + self.args.flood_length
+            while not self.killed and time.monotonic() < time_end:
+                if random.randint(0, 19) == 0:
+                    self.broker.publish(TUNE_TOPIC, random.choice(tunes))
+                else:
+                    self.broker.publish(COMMAND_TOPIC, random.choice(commands))
+                self.commands += 1
+                time.sleep(1.0 / self.args.command_rate)
+            # Leave the lights on their timer between floods
+            self.broker.publish(COMMAND_TOPIC, "AUTO")
+            self.sleep(self.args.flood_every)
+
+    def pings(self):
+        """ Timed PING sweeps, like monitor.py """
+        while not self.killed:
+            self.lock.acquire()
+            try:
+                self.ping_seq += 1
+                seq = str(self.ping_seq)
+                self.ping_sent = {seq: time.monotonic()}
+            finally:
+                self.lock.release()
+            self.broker.publish(
+                doorbell_ringer.MQTT_TOPIC[1][0],
+                events.encode("PING", seq=seq, t0=time.time(), **{"from": MQTT_CLIENT_ID})
+            )
+            self.sleep(self.args.ping_every)
+
+    def sleep(self, seconds):
+        """ Sleep, waking early if stopped """
+        time_end = time.monotonic() + seconds
+        while not self.killed and time.monotonic() < time_end:
+            time.sleep(min(0.5, time_end - time.monotonic()))
+
+    # ---- reporting ----
+
+    def report(self, final=False):
+        elapsed = max(0.001, time.monotonic() - self.time_start)
+        threads = threading.active_count()
+        self.threads_peak = max(self.threads_peak, threads)
+        if final:
+            gc.collect()
+        rss = rss_bytes()
+        objects = len(gc.get_objects())
+        hours = elapsed / 3600.0
+        lines = [
+            "{} after {:.0f}s".format("Final" if final else "Soak", elapsed),
+            "  load: {} presses, {} commands, {} pings".format(
+                self.presses, self.commands, self.ping_seq),
+            "  throughput: {:.1f} msg/s ({} queued, {} local)".format(
+                (self.broker.delivered + self.local_messages) / elapsed,
+                self.broker.delivered, self.local_messages),
+            "  " + self.ring.format_summary(),
+            "  " + self.broker.delivery.format_summary(),
+        ]
+        for name in DEVICES:
+            lines.append("  " + self.ping_rtt[name].format_summary())
+        lines += [
+            "  threads: {} now, {} peak, {} at start".format(
+                threads, self.threads_peak, self.threads_start),
+            "  memory: rss {:.1f}MB ({:+.1f}MB, {:+.1f}MB/h), objects {} ({:+d})".format(
+                rss / 1048576.0, (rss - self.rss_start) / 1048576.0,
+                (rss - self.rss_start) / 1048576.0 / hours,
+                objects, objects - self.objects_start),
+            "  dropped: {} outbox, {} expired, {} suppressed, {} log lines, {} voices stolen".format(
+                self.button.outbox.dropped,
+                self.ringer.expired.total + self.lights.expired.total,
+                self.button.limiter.suppressed.total + self.ringer.limiter.suppressed.total,
+                logger.writer().dropped,
+                self.ringer.audio.mixer.stolen),
+        ]
+        print("\n".join(lines))
+        sys.stdout.flush()
+
+    def run(self):
+        threads = []
+        for target in (self.storms, self.floods, self.pings):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        button_thread = threading.Thread(target=self.button.run)
+        button_thread.daemon = True
+        button_thread.start()
+        lights_thread = threading.Thread(target=self.lights.run)
+        lights_thread.daemon = True
+        lights_thread.start()
+
+        time_end = self.time_start + self.args.duration
+        next_report = self.time_start + self.args.report
+        while time.monotonic() < time_end:
+            time.sleep(min(1.0, max(0, time_end - time.monotonic())))
+            self.threads_peak = max(self.threads_peak, threading.active_count())
+            if time.monotonic() >= next_report:
+                self.report()
+                next_report += self.args.report
+        self.stop()
+        for thread in threads:
+            thread.join(5)
+        self.report(final=True)
+
+    def stop(self):
+        self.killed = True
+        self.button.killed = True
+        self.lights.set_exit()
+        self.ringer.library.stop()
+        self.ringer.clock.stop()
+        self.ringer.audio.stop()
+        self.broker.stop()
+
+    def cleanup(self):
+        self.button.outbox.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak test the doorbell daemons")
+    parser.add_argument("--duration", type=float, default=3600, help="seconds to run")
+    parser.add_argument("--report", type=float, default=60, help="seconds between reports")
+    parser.add_argument("--storm-size", type=int, default=20, help="presses per storm")
+    parser.add_argument("--storm-every", type=float, default=30, help="seconds between storms")
+    parser.add_argument("--commands", default="ON,OFF,AUTO",
+                        help="dashboard commands to flood with, PARTY runs a busy loop")
+    parser.add_argument("--command-rate", type=float, default=20, help="commands per second in a flood")
+    parser.add_argument("--flood-length", type=float, default=5, help="seconds per flood")
+    parser.add_argument("--flood-every", type=float, default=60, help="seconds between floods")
+    parser.add_argument("--ping-every", type=float, default=10, help="seconds between PING sweeps")
+    parser.add_argument("--sync-delay", type=float, default=0.0,
+                        help="SYNC_PLAY_DELAY for the button, 0 so ring latency is all overhead")
+    parser.add_argument("--inputs", type=int, default=1, help="doorbell inputs to press, on pins 23 up")
+    args = parser.parse_args()
+
+    soak = Soak(args)
+    try:
+        soak.run()
+    except KeyboardInterrupt:
+        soak.stop()
+        soak.report(final=True)
+    finally:
+        soak.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+import os
+import time
+import threading
+from collections import OrderedDict
+import audio
+import logger
+
+# Name of the tune set made from the files directly in the sounds folder
+DEFAULT_SET = "default"
+# Selecting this picks the seasonal set for today, or the default
+AUTO_SET = "AUTO"
+DING_FILE = "ding.wav"
+DONG_FILE = "dong.wav"
+# Seasonal tune sets, (start month, start day, end month, end day, set name)
+SEASONAL_SETS = [
+    (12, 1, 1, 5, "christmas"),
+    (10, 24, 10, 31, "halloween"),
+]
+# Decoded audio kept in memory, in bytes
+CACHE_BUDGET = 32 * 1024 * 1024
+# Seconds between checks of the sounds folder for changed files
+WATCH_INTERVAL = 5.0
+
+
+def in_date_range(date, start_month, start_day, end_month, end_day):
+    """ Is a date within a range of days, which may straddle new year """
+    today = (date.tm_mon, date.tm_mday)
+    start = (start_month, start_day)
+    end = (end_month, end_day)
+    if start <= end:
+        return start <= today <= end
+    return today >= start or today <= end
+
+
+class DecodedCache():
+
+    def __init__(self, budget=CACHE_BUDGET, rate=audio.ENGINE_RATE,
+                 channels=audio.ENGINE_CHANNELS):
+        # Decoded sounds by filename, least recently used first
+        self.entries = OrderedDict()
+        # (mtime, size) of each file when it was decoded
+        self.stamps = {}
+        # Filenames that may not be evicted (the selected tunes)
+        self.pinned = set()
+        self.budget = budget
+        self.used = 0
+        self.rate = rate
+        self.channels = channels
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Thread lock
+        self.lock = threading.Lock()
+
+    def sound_bytes(self, sound):
+        """ Memory a decoded sound takes, PCM plus mixer samples """
+        return len(sound.pcm) + sound.mix_samples().nbytes
+
+    def stamp(self, filename):
+        st = os.stat(filename)
+        return (st.st_mtime, st.st_size)
+
+    def get(self, filename):
+        """ Return a decoded sound, decoding it on a miss """
+        self.lock.acquire()
+        try:
+            sound = self.entries.get(filename)
+            if sound is not None:
+                self.entries.move_to_end(filename)
+                self.hits += 1
+                return sound
+            self.misses += 1
+        finally:
+            self.lock.release()
+
+        # Decode outside the lock, it is the slow part
+        stamp = self.stamp(filename)
+        sound = audio.load_wav(filename, self.rate, self.channels)
+        size = self.sound_bytes(sound)
+
+        self.lock.acquire()
+        try:
+            self._remove(filename)
+            self.entries[filename] = sound
+            self.stamps[filename] = stamp
+            self.used += size
+            self._evict()
+        finally:
+            self.lock.release()
+        return sound
+
+    def _remove(self, filename):
+        sound = self.entries.pop(filename, None)
+        self.stamps.pop(filename, None)
+        if sound is not None:
+            self.used -= self.sound_bytes(sound)
+
+    def _evict(self):
+        """ Drop least recently used, unpinned sounds until within budget """
+        for filename in list(self.entries.keys()):
+            if self.used <= self.budget:
+                return
+            if filename in self.pinned:
+                continue
+            self._remove(filename)
+            self.evictions += 1
+
+    def pin(self, filenames):
+        """ Keep just these files from being evicted """
+        self.lock.acquire()
+        try:
+            self.pinned = set(filenames)
+            self._evict()
+        finally:
+            self.lock.release()
+
+    def invalidate(self, filename):
+        self.lock.acquire()
+        try:
+            self._remove(filename)
+        finally:
+            self.lock.release()
+
+    def changed(self):
+        """ Cached files whose mtime or size differ from when decoded """
+        self.lock.acquire()
+        try:
+            items = list(self.stamps.items())
+        finally:
+            self.lock.release()
+        result = []
+        for filename, stamp in items:
+            try:
+                if self.stamp(filename) != stamp:
+                    result.append(filename)
+            except OSError:
+                # File deleted
+                result.append(filename)
+        return result
+
+
+# Named sets of ding/dong tunes. The files directly in the sounds folder
+# make up the default set and each sub folder is another set, e.g.
+# sounds/christmas/ding.wav. Selecting a set decodes it in the background
+# and only then switches over, so the ring path never touches the disk.
+class SoundLibrary():
+
+    def __init__(self, folder, cache=None):
+        # Constructor
+        self.folder = folder
+        self.log = logger.get_logger("soundlibrary")
+        self.cache = cache
+        if self.cache is None:
+            self.cache = DecodedCache()
+        # Set name as requested (may be AUTO) and the one actually in use
+        self.requested = AUTO_SET
+        self.selected = None
+        # Goes up with every selection, so a slow decode finishing after
+        # a newer selection is thrown away rather than swapped in
+        self.generation = 0
+        # Sounds ready to play for the selected set
+        self.ding = None
+        self.dong = None
+        # Sets rung by name (e.g. by a doorbell input with its own
+        # tune), decoded ahead of time. Name mapped to (ding, dong)
+        self.extras = {}
+        self.lock = threading.Lock()
+        self.exit = False
+        self.watch_thread = None
+
+    def set_names(self):
+        """ Names of all available tune sets """
+        names = []
+        if os.path.isfile(os.path.join(self.folder, DING_FILE)):
+            names.append(DEFAULT_SET)
+        for entry in sorted(os.listdir(self.folder)):
+            if os.path.isdir(os.path.join(self.folder, entry)):
+                names.append(entry)
+        return names
+
+    def set_files(self, name):
+        """ Ding and dong filenames for a set """
+        folder = self.folder
+        if name != DEFAULT_SET:
+            folder = os.path.join(self.folder, name)
+        return (
+            os.path.join(folder, DING_FILE),
+            os.path.join(folder, DONG_FILE)
+        )
+
+    def resolve(self, name, date=None):
+        """ Turn AUTO into today's seasonal set, if there is one """
+        if name != AUTO_SET:
+            return name
+        if date is None:
+            date = time.localtime()
+        names = self.set_names()
+        for start_month, start_day, end_month, end_day, season in SEASONAL_SETS:
+            if season in names and in_date_range(
+                date, start_month, start_day, end_month, end_day
+            ):
+                return season
+        return DEFAULT_SET
+
+    def select(self, name):
+        """ Switch to a tune set (or AUTO). Returns False if unknown """
+        if name != AUTO_SET and name not in self.set_names():
+            self.log.warning("Unknown tune set: {}", name)
+            return False
+        self.lock.acquire()
+        try:
+            self.requested = name
+            self.generation += 1
+            generation = self.generation
+        finally:
+            self.lock.release()
+        return self.load(self.resolve(name), generation)
+
+    def load(self, name, generation=None):
+        """ Decode a set and make it the one that rings, unless another
+        selection has been made since generation """
+        ding_file, dong_file = self.set_files(name)
+        ding = None
+        dong = None
+        if os.path.isfile(ding_file):
+            ding = self.cache.get(ding_file)
+        if os.path.isfile(dong_file):
+            dong = self.cache.get(dong_file)
+        if ding is None and dong is None:
+            self.log.warning("Tune set has no sounds: {}", name)
+            return False
+        self.lock.acquire()
+        try:
+            if generation is not None and generation != self.generation:
+                self.log.info("Tune set {} superseded", name)
+                return False
+            self.selected = name
+            self.ding = ding
+            self.dong = dong
+        finally:
+            self.lock.release()
+        self.pin_sets()
+        self.log.info("Tune set: {}", name)
+        return True
+
+    def pin_sets(self):
+        """ Keep the selected and extra sets in the cache """
+        names = list(self.extras)
+        if self.selected is not None:
+            names.append(self.selected)
+        filenames = []
+        for name in names:
+            filenames.extend(f for f in self.set_files(name) if os.path.isfile(f))
+        self.cache.pin(filenames)
+
+    def preload(self, names):
+        """ Decode the sets that may be rung by name, replacing any
+        decoded before. Unknown sets are left out """
+        known = self.set_names()
+        extras = {}
+        for name in names:
+            if name not in known:
+                self.log.warning("Unknown tune set: {}", name)
+                continue
+            sounds = []
+            for filename in self.set_files(name):
+                sound = None
+                if os.path.isfile(filename):
+                    sound = self.cache.get(filename)
+                sounds.append(sound)
+            extras[name] = tuple(sounds)
+        self.lock.acquire()
+        try:
+            self.extras = extras
+        finally:
+            self.lock.release()
+        self.pin_sets()
+
+    def get_set(self, name):
+        """ Ding and dong of a preloaded set, falling back to the
+        selected set for anything not preloaded """
+        self.lock.acquire()
+        try:
+            ding, dong = self.extras.get(name, (None, None))
+            return (ding or self.ding, dong or self.dong)
+        finally:
+            self.lock.release()
+
+    def check(self):
+        """ Reload anything changed on disk, and follow the season """
+        changed = self.cache.changed()
+        for filename in changed:
+            self.log.info("Sound changed: {}", filename)
+            self.cache.invalidate(filename)
+        generation = self.generation
+        current = self.resolve(self.requested)
+        # New files dropped into the selected set
+        added = [
+            f for f in self.set_files(current)
+            if os.path.isfile(f) and f not in self.cache.stamps
+        ]
+        if len(changed) > 0 or len(added) > 0 or current != self.selected:
+            # Decode again off the ring path, then swap in
+            self.load(current, generation)
+        if len(changed) > 0 and len(self.extras) > 0:
+            self.preload(list(self.extras))
+
+    def watch(self, interval=WATCH_INTERVAL):
+        """ Start a thread watching the sounds folder for changes """
+        self.watch_thread = threading.Thread(target=self._watch, args=(interval,))
+        self.watch_thread.daemon = True
+        self.watch_thread.start()
+
+    def _watch(self, interval):
+        while not self.exit:
+            time.sleep(interval)
+            try:
+                self.check()
+            except Exception as e:
+                # Half written file, try again next time round
+                self.log.error("Sound reload failed: {}", e)
+
+    def stop(self):
+        self.exit = True
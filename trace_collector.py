@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# Collects the span timings of traced rings into a local SQLite
+# database and answers queries about them, e.g.
+#   python3 trace_collector.py                run the collector
+#   python3 trace_collector.py STAGES 24      stage percentiles, last 24 hours
+#   python3 trace_collector.py RECENT 10      latest rings and their totals
+#   python3 trace_collector.py TRACE 1a2b3c4d timeline of one ring
+# The same queries can be published to query/traces, answered on
+# query/traces/reply.
+import sys
+import time
+import sqlite3
+import threading
+import transport
+import events
+import metrics
+import tracing
+
+MQTT_CLIENT_ID = "trace_collector"
+MQTT_SUB_TOPIC = [(tracing.SPAN_TOPIC, 0), ("query/traces", 1)]
+MQTT_PUB_TOPIC = [("query/traces/reply", 1)]
+DATABASE_FILE = "/home/pi/DoorBell/traces.db"
+# Spans older than this are deleted
+RETENTION_DAYS = 14
+# Seconds between clean ups
+PRUNE_INTERVAL = 3600
+# Seconds spans are batched for before being committed to disk
+COMMIT_INTERVAL = 1.0
+SECONDS_PER_DAY = 24 * 60 * 60
+# Stages in the order a ring passes through them
+STAGES = [
+    ("doorbell_button", "button"),
+    ("doorbell_button", "ack"),
+    ("front_door_ringer", "deliver"),
+    ("front_door_ringer", "dispatch"),
+    ("front_door_ringer", "audio"),
+]
+
+
+class TraceStore():
+
+    def __init__(self, filename):
+        # Constructor
+        self.filename = filename
+        # Thread lock, the database is shared by the MQTT and query threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS spans ("
+            "tid TEXT, component TEXT, stage TEXT, start REAL, end REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS spans_tid ON spans (tid)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS spans_start ON spans (start)")
+        self.db.commit()
+        self.last_prune = 0.0
+        # Spans are committed in batches, a commit is an fsync
+        self.last_commit = time.monotonic()
+        self.uncommitted = 0
+
+    def add(self, trace_id, component, stage, start, end):
+        time_now = time.monotonic()
+        self.lock.acquire()
+        try:
+            self.db.execute(
+                "INSERT INTO spans VALUES (?, ?, ?, ?, ?)",
+                (trace_id, component, stage, start, end)
+            )
+            self.uncommitted += 1
+            if time_now - self.last_prune > PRUNE_INTERVAL:
+                self.last_prune = time_now
+                self.db.execute(
+                    "DELETE FROM spans WHERE start < ?",
+                    (time.time() - RETENTION_DAYS * SECONDS_PER_DAY,)
+                )
+            if time_now - self.last_commit >= COMMIT_INTERVAL:
+                self._commit(time_now)
+        finally:
+            self.lock.release()
+
+    def _commit(self, time_now):
+        self.db.commit()
+        self.last_commit = time_now
+        self.uncommitted = 0
+
+    def flush(self):
+        """ Commit any spans still waiting for the next batch """
+        self.lock.acquire()
+        try:
+            if self.uncommitted > 0:
+                self._commit(time.monotonic())
+        finally:
+            self.lock.release()
+
+    def _select(self, sql, args=()):
+        self.lock.acquire()
+        try:
+            return self.db.execute(sql, args).fetchall()
+        finally:
+            self.lock.release()
+
+    def timeline(self, trace_id):
+        """ Spans of one ring in order, as (component, stage, offset, duration)
+        in seconds from the start of the ring """
+        rows = self._select(
+            "SELECT component, stage, start, end FROM spans WHERE tid = ? "
+            "ORDER BY start", (trace_id,)
+        )
+        if len(rows) == 0:
+            return []
+        first = rows[0][2]
+        return [
+            (component, stage, start - first, end - start)
+            for component, stage, start, end in rows
+        ]
+
+    def recent(self, count=10):
+        """ Latest rings as (trace ID, wall time, total seconds), newest first """
+        return self._select(
+            "SELECT tid, MIN(start), MAX(end) - MIN(start) FROM spans "
+            "GROUP BY tid ORDER BY MIN(start) DESC LIMIT ?", (count,)
+        )
+
+    def stages(self, hours=24):
+        """ LatencyRecorders of each stage, and the total, over recent rings """
+        since = time.time() - hours * 3600
+        recorders = {}
+        for component, stage in STAGES:
+            recorders[stage] = metrics.LatencyRecorder(stage, window=100000)
+        rows = self._select(
+            "SELECT stage, end - start FROM spans WHERE start >= ?", (since,)
+        )
+        for stage, duration in rows:
+            if stage not in recorders:
+                recorders[stage] = metrics.LatencyRecorder(stage, window=100000)
+            recorders[stage].record(duration)
+        totals = metrics.LatencyRecorder("total", window=100000)
+        rows = self._select(
+            "SELECT MAX(end) - MIN(start) FROM spans WHERE start >= ? "
+            "GROUP BY tid", (since,)
+        )
+        for total, in rows:
+            totals.record(total)
+        return [recorders[name] for name in recorders] + [totals]
+
+    def query(self, request):
+        """ Answer a text query, as received over MQTT.
+        "STAGES [hours]", "RECENT [count]" or "TRACE <id>" """
+        parts = request.split()
+        if len(parts) == 0:
+            return "ERROR empty query"
+        command = parts[0].upper()
+        if command == "TRACE":
+            if len(parts) < 2:
+                return "ERROR missing trace id"
+            spans = self.timeline(parts[1])
+            if len(spans) == 0:
+                return "ERROR unknown trace " + parts[1]
+            return "TRACE {} ".format(parts[1]) + " ".join(
+                "{}.{}=+{:.3f}/{:.3f}ms".format(
+                    component, stage, offset * 1000.0, duration * 1000.0
+                ) for component, stage, offset, duration in spans
+            )
+        count = 24 if command == "STAGES" else 10
+        if len(parts) > 1:
+            try:
+                count = int(parts[1])
+            except ValueError:
+                return "ERROR bad count"
+        if command == "STAGES":
+            return "STAGES " + " | ".join(
+                recorder.format_summary() for recorder in self.stages(count)
+            )
+        if command == "RECENT":
+            return "RECENT " + " ".join(
+                "{}@{}={:.3f}ms".format(
+                    trace_id, time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start)),
+                    total * 1000.0
+                ) for trace_id, start, total in self.recent(count)
+            )
+        return "ERROR unknown query " + parts[0]
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.uncommitted > 0:
+                self.db.commit()
+            self.db.close()
+        finally:
+            self.lock.release()
+
+
+class TraceCollector():
+
+    def __init__(self, filename=DATABASE_FILE, client=None):
+        """ Initialise member variables.
+        Pass an eventbus client to run in co-located mode """
+        self.store = TraceStore(filename)
+        self.killed = False
+        # Held while a query is answered
+        self.query_lock = threading.Lock()
+
+        # MQTT Initialisation
+        self.transport = transport.Transport(MQTT_CLIENT_ID, client)
+        self.log = self.transport.log
+        self.transport.subscribe(MQTT_SUB_TOPIC[0][0], self.on_span, MQTT_SUB_TOPIC[0][1])
+        self.transport.subscribe(MQTT_SUB_TOPIC[1][0], self.on_query)
+        self.transport.start()
+
+    def on_span(self, topic, message, raw):
+        """ Span received from one of the components """
+        name, fields = events.decode(message)
+        if name != "SPAN":
+            return
+        start = events.field_float(fields, "start")
+        end = events.field_float(fields, "end")
+        if "tid" not in fields or start is None or end is None:
+            return
+        self.store.add(
+            fields["tid"], fields.get("c", ""), fields.get("stage", ""), start, end
+        )
+
+    def on_query(self, topic, message, raw):
+        """ Trace query received """
+        # Keep the MQTT thread free for spans. One query at a time,
+        # so a flood of them can not pin the CPU
+        if not self.query_lock.acquire(False):
+            self.transport.publish(MQTT_PUB_TOPIC[0][0], "ERROR busy")
+            return
+        thread = threading.Thread(target=self.answer_query, args=(message,))
+        thread.daemon = True
+        thread.start()
+
+    def answer_query(self, request):
+        try:
+            reply = self.store.query(request)
+        finally:
+            self.query_lock.release()
+        self.transport.publish(MQTT_PUB_TOPIC[0][0], reply)
+
+    def run(self):
+        while not self.killed:
+            time.sleep(1)
+            # Spans of the latest ring reach the disk within a second
+            self.store.flush()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        store = TraceStore(DATABASE_FILE)
+        print(store.query(" ".join(sys.argv[1:])))
+        store.close()
+    else:
+        collector = TraceCollector()
+        try:
+            collector.run()
+        except:
+            pass
+        finally:
+            collector.transport.stop()
+            collector.store.close()
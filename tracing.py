@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+import os
+import time
+import events
+
+# Every component reports the stages of a ring here
+SPAN_TOPIC = "trace/span"
+# Field carrying the trace ID in event payloads
+TRACE_FIELD = "tid"
+
+
+def new_trace_id():
+    """ Short random ID, one per ring event """
+    return os.urandom(4).hex()
+
+
+def wall_time(mono, time_now=None, mono_now=None):
+    """ Wall clock time of a reading of the monotonic clock """
+    if time_now is None:
+        time_now = time.time()
+    if mono_now is None:
+        mono_now = time.monotonic()
+    return time_now - (mono_now - mono)
+
+
+# Reports span timings for traced rings. Each span is one stage of a
+# ring on one component, published as a single QoS 0 message so it
+# costs the ring path no more than a queued publish. Times are sent on
+# the doorbell button's clock when a ClockSync is given, so spans from
+# different Pis line up in the collector.
+class Tracer():
+
+    def __init__(self, transport, component, clock=None):
+        # Constructor
+        self.transport = transport
+        self.component = component
+        self.clock = clock
+
+    def span(self, trace_id, stage, start, end):
+        """ Report a stage of a ring, start and end on our wall clock """
+        if trace_id is None:
+            return
+        if self.clock is not None and self.clock.synced:
+            start = self.clock.to_reference(start)
+            end = self.clock.to_reference(end)
+        self.transport.publish(SPAN_TOPIC, events.encode(
+            "SPAN", tid=trace_id, c=self.component, stage=stage,
+            start=start, end=end
+        ))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+import threading
+import paho.mqtt.client as mqtt
+import logger
+
+MQTT_HOST = "localhost"
+MQTT_PORT = 1883
+MQTT_KEEPALIVE = 120
+MQTT_USER = ""
+MQTT_PASS = ""
+# Seconds between connection attempts, doubling up to the max
+MQTT_RECONNECT_MIN = 1
+MQTT_RECONNECT_MAX = 60
+# QoS 1/2 messages allowed on the wire awaiting an ack. Doorbell traffic
+# is tiny, a modest window stops a replayed backlog hogging the link
+MQTT_MAX_INFLIGHT = 10
+# Messages paho queues while the window is full, 0 is unlimited
+MQTT_MAX_QUEUED = 0
+# Return code of a successful publish
+MQTT_ERR_SUCCESS = mqtt.MQTT_ERR_SUCCESS
+# Return code of a QoS 1/2 publish made while the connection is down.
+# paho has still queued the message and sends it on reconnect
+MQTT_ERR_NO_CONN = mqtt.MQTT_ERR_NO_CONN
+
+
+def topic_matches(sub, topic):
+    """ Does a topic match a subscription, including + and # wildcards """
+    sub_parts = sub.split("/")
+    topic_parts = topic.split("/")
+    for index, part in enumerate(sub_parts):
+        if part == "#":
+            return True
+        if index >= len(topic_parts):
+            return False
+        if part != "+" and part != topic_parts[index]:
+            return False
+    return len(sub_parts) == len(topic_parts)
+
+
+# Shared MQTT setup for every daemon: one client per daemon with a
+# persistent session, connecting in the background with backoff, and
+# dispatching messages to handlers registered per topic. Logging is
+# queued and levelled so nothing on the publish or message path
+# blocks on stdout.
+class Transport():
+
+    def __init__(self, client_id, client=None, host=MQTT_HOST, port=MQTT_PORT,
+                 keepalive=MQTT_KEEPALIVE, user=MQTT_USER, password=MQTT_PASS):
+        # Constructor
+        self.client_id = client_id
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.log = logger.get_logger(client_id)
+        # Handlers, each (topic filter, qos, function(topic, payload, message))
+        self.handlers = []
+        # Extra callbacks for daemons that need them
+        self.connect_hooks = []
+        self.disconnect_hooks = []
+        self.publish_hook = None
+        self.connected = False
+        self.lock = threading.Lock()
+
+        # Pass an eventbus client to run in co-located mode
+        self.client = client
+        if self.client is None:
+            self.client = mqtt.Client(client_id=client_id, clean_session=False)
+            self.client.max_inflight_messages_set(MQTT_MAX_INFLIGHT)
+            self.client.max_queued_messages_set(MQTT_MAX_QUEUED)
+        self.client.username_pw_set(user, password)
+        self.client.reconnect_delay_set(MQTT_RECONNECT_MIN, MQTT_RECONNECT_MAX)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+        self.client.on_publish = self.on_publish
+        self.client.on_subscribe = self.on_subscribe
+
+    def subscribe(self, topic, handler, qos=1):
+        """ Call handler(topic, payload, message) for matching messages """
+        self.lock.acquire()
+        try:
+            self.handlers.append((topic, qos, handler))
+            connected = self.connected
+        finally:
+            self.lock.release()
+        if connected:
+            self.client.subscribe(topic, qos)
+
+    def start(self):
+        """ Connect in the background, retrying with backoff until the
+        broker is up, so start up never blocks on it """
+        self.client.connect_async(self.host, self.port, self.keepalive)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.loop_stop()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.log.debug("publish {} {}", topic, payload)
+        return self.client.publish(topic, payload, qos, retain)
+
+    def on_connect(self, mqttc, obj, flags, rc):
+        if rc != 0:
+            self.log.warning("Connect refused, rc: {}", rc)
+            return
+        self.log.info("Connected")
+        self.lock.acquire()
+        try:
+            self.connected = True
+            topics = [(topic, qos) for topic, qos, handler in self.handlers]
+        finally:
+            self.lock.release()
+        if len(topics) > 0:
+            self.client.subscribe(topics)
+        for hook in self.connect_hooks:
+            hook()
+
+    def on_disconnect(self, mqttc, obj, rc):
+        self.connected = False
+        if rc != 0:
+            self.log.warning("Disconnected, rc: {}, reconnecting", rc)
+        for hook in self.disconnect_hooks:
+            hook()
+
+    def on_message(self, mqttc, obj, message):
+        """ Pass the message to every matching handler """
+        topic = str(message.topic)
+        payload = message.payload.decode("utf-8", "replace")
+        self.log.debug("message {} {} {}", topic, message.qos, payload)
+        for sub, qos, handler in self.handlers:
+            if topic_matches(sub, topic):
+                try:
+                    handler(topic, payload, message)
+                except Exception as e:
+                    self.log.error("Handler for {} failed: {}", topic, e)
+
+    def on_publish(self, mqttc, obj, mid):
+        if self.publish_hook is not None:
+            self.publish_hook(mid)
+
+    def on_subscribe(self, mqttc, obj, mid, granted_qos):
+        self.log.debug("Subscribed: {} {}", mid, granted_qos)